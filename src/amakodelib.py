@@ -0,0 +1,5275 @@
+############################################################################
+# Transcoder for Amarok
+#
+# This is the bulk of amaKode. amakode.py only starts it, so that python
+# can keep this module compiled instead of compiling it on every start.
+#
+# The optional module tagpy (http://news.tiker.net/software/tagpy) is used
+# for tag information processing. This allows for writing tags into the
+# transcoded files.
+#
+############################################################################
+#
+# Copyright (C) 2007 Daniel O'Connor. All rights reserved.
+# Copyright (C) 2007 Jens Zurheide. All rights reserved.
+# Copyright (C) 2008 Toby Dickenson. All rights reserved.
+# Copyright (C) 2010 Bruce Duncan.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+############################################################################
+
+__version__ = "2.0"
+
+import time
+# for --profile-startup
+loadtime = time.time()
+
+import os
+import sys
+import signal
+import logging
+import logging.handlers
+import select
+import fcntl
+import errno
+import threading
+import struct
+import marshal
+import heapq
+import collections
+import math
+import resource
+import atexit
+from StringIO import StringIO
+from optparse import OptionParser
+
+
+class LazyModule(object):
+    """Stands in for the first of the modules named which can be imported,
+    but only imports it when one of its attributes is first used. The
+    Amarok script is started whenever transcoding is turned on, so it
+    shouldn't pay for modules it may never need.
+
+    A LazyModule is false if none of the modules can be imported.
+    """
+
+    def __init__(self, *names):
+        self._names = names
+        self._module = None
+        self._loaded = False
+
+    def _load(self):
+        if not self._loaded:
+            for name in self._names:
+                try:
+                    self._module = __import__(name)
+                    break
+                except ImportError:
+                    pass
+            self._loaded = True
+        return self._module
+
+    def __nonzero__(self):
+        return self._load() is not None
+
+    def __getattr__(self, attr):
+        module = self._load()
+        if module is None:
+            raise ImportError("No module named " + self._names[0])
+        return getattr(module, attr)
+
+socket = LazyModule('socket')
+subprocess = LazyModule('subprocess')
+tempfile = LazyModule('tempfile')
+shutil = LazyModule('shutil')
+glob = LazyModule('glob')
+wave = LazyModule('wave')
+urllib = LazyModule('urllib')
+urlparse = LazyModule('urlparse')
+base64 = LazyModule('base64')
+# optional
+tagpy = LazyModule('tagpy')
+sqlite3 = LazyModule('sqlite3')
+json = LazyModule('json', 'simplejson')
+
+
+def sha1():
+    """Return a new sha1 hash object"""
+    try:
+        from hashlib import sha1 as new
+    except ImportError:
+        from sha import new
+    return new()
+
+
+def main(launched=None):
+    """Run amaKode. launched is when the amakode.py script started, for
+    --profile-startup."""
+    setup_start = time.time()
+    parser = OptionParser()
+    parser.add_option("--test",
+                    action="store_true", dest="test", default=False,
+                    help="check the tag writers and run a test")
+    parser.add_option("-f", "--format",
+                    action="store", dest="format",
+                    default="ogg", help="output format, or a comma "
+                    "separated list of formats to decode each input once and "
+                    "encode it to all of them")
+    parser.add_option("-j", "--jobs",
+                    action="store", type="int", dest="jobs", default=None,
+                    help="number of concurrent jobs (default: one per "
+                    "processor)")
+    parser.add_option("--adaptive",
+                    action="store_true", dest="adaptive", default=False,
+                    help="change the number of concurrent jobs to suit the "
+                    "load on the machine")
+    parser.add_option("--min-jobs",
+                    action="store", type="int", dest="min_jobs", default=1,
+                    help="fewest concurrent jobs with --adaptive")
+    parser.add_option("--max-jobs",
+                    action="store", type="int", dest="max_jobs", default=None,
+                    help="most concurrent jobs with --adaptive (default: two "
+                    "per processor)")
+    parser.add_option("--nice",
+                    action="store", type="int", dest="nice", default=0,
+                    help="run decoders and encoders at a lower priority")
+    parser.add_option("--ionice",
+                    action="store", type="choice", dest="ionice",
+                    choices=["best-effort", "idle"], default=None,
+                    help="run decoders and encoders in this I/O scheduling "
+                    "class (best-effort or idle)")
+    parser.add_option("--cgroup",
+                    action="store", dest="cgroup", default=None,
+                    help="put decoders and encoders in this cgroup directory")
+    parser.add_option("-r", "--recursive",
+                    action="store_true", dest="recursive", default=False,
+                    help="transcode every file found under directories")
+    parser.add_option("-o", "--output-dir",
+                    action="store", dest="output_dir", default=None,
+                    help="write output to a tree mirroring the input "
+                    "(default: next to the input files)")
+    parser.add_option("--cache-dir",
+                    action="store", dest="cache_dir", default=None,
+                    help="directory used to cache transcoded files "
+                    "(default: amakode-cache in the state directory)")
+    parser.add_option("--cache-size",
+                    action="store", type="int", dest="cache_size",
+                    default=512, help="maximum size of the cache in MiB")
+    parser.add_option("--cache-hash",
+                    action="store_true", dest="cache_hash", default=False,
+                    help="identify cached sources by their contents rather "
+                    "than their size and modification time")
+    parser.add_option("--no-cache",
+                    action="store_false", dest="cache", default=True,
+                    help="always transcode, never use the cache")
+    parser.add_option("--index",
+                    action="store", dest="index", default=None,
+                    help="database remembering the tags and length of each "
+                    "source file (default: amakode-index.db in the state "
+                    "directory)")
+    parser.add_option("--no-index",
+                    action="store_false", dest="use_index", default=True,
+                    help="always read tags from the source files")
+    parser.add_option("--journal",
+                    action="store", dest="journal", default="",
+                    help="file recording the queued jobs, so that they can "
+                    "be resumed after a crash or restart (default: "
+                    "amakode-journal in the state directory)")
+    parser.add_option("--no-journal",
+                    action="store_const", dest="journal", const=None,
+                    help="don't keep a journal of the queued jobs")
+    parser.add_option("--stats-file",
+                    action="store", dest="stats_file", default=None,
+                    help="append a line of JSON describing each finished job "
+                    "to this file")
+    parser.add_option("--benchmark",
+                    action="store_true", dest="benchmark", default=False,
+                    help="time every decoder and encoder on generated audio "
+                    "and print the results as JSON")
+    parser.add_option("--benchmark-jobs",
+                    action="store", dest="benchmark_jobs", default=None,
+                    help="comma separated numbers of concurrent jobs to "
+                    "benchmark (default: 1 and one per processor)")
+    parser.add_option("--benchmark-length",
+                    action="store", type="int", dest="benchmark_length",
+                    default=30, help="length of each benchmark file in "
+                    "seconds")
+    parser.add_option("--no-copy",
+                    action="store_false", dest="copy", default=True,
+                    help="transcode files which are already in the output "
+                    "format instead of copying them")
+    parser.add_option("--max-copy-bitrate",
+                    action="store", type="int", dest="max_copy_bitrate",
+                    default=None, help="only copy files already in the "
+                    "output format if their bitrate is at most this many "
+                    "kbit/s (default: about what the encoder would produce; "
+                    "needs tagpy)")
+    parser.add_option("--split-over",
+                    action="store", type="int", dest="split_over", default=0,
+                    help="encode sources longer than this many seconds to "
+                    "mp3 or ogg in segments on the idle job slots, and join "
+                    "them. mp3 segments are encoded without lame's bit "
+                    "reservoir so they join without gaps, which costs a "
+                    "little quality. Joined ogg files are chained streams, "
+                    "which some players reject, with tags in the first link "
+                    "only (default: 0, never)")
+    parser.add_option("--pipe-size",
+                    action="store", type="int", dest="pipe_size", default=0,
+                    help="size in KiB of the pipes between processes "
+                    "(default: the system's)")
+    parser.add_option("--pipe-buffer",
+                    action="store", type="int", dest="pipe_buffer",
+                    default=0, help="buffer up to this many KiB between "
+                    "each decoder and encoder, and record how long each "
+                    "waited for the other (default: 0, no buffer)")
+    parser.add_option("--sync",
+                    action="store_true", dest="sync", default=False,
+                    help="mirror the directory given as the first argument "
+                    "into the second, only transcoding new or changed files "
+                    "and deleting outputs whose source has gone")
+    parser.add_option("--daemon",
+                    action="store_true", dest="daemon", default=False,
+                    help="run the jobs of commandline invocations which "
+                    "connect to --socket, sharing one limit on the number of "
+                    "jobs")
+    parser.add_option("--socket",
+                    action="store", dest="socket", default=None,
+                    help="socket of the daemon (default: amakode.sock in "
+                    "~/.amakode)")
+    parser.add_option("--no-daemon",
+                    action="store_false", dest="use_daemon", default=True,
+                    help="run the jobs here even if a daemon is running")
+    parser.add_option("--status",
+                    action="store_true", dest="status", default=False,
+                    help="show what the daemon is doing")
+    parser.add_option("--list-tools",
+                    action="store_true", dest="list_tools", default=False,
+                    help="show the external programs that will be used")
+    parser.add_option("--profile-startup",
+                    action="store_true", dest="profile_startup",
+                    default=False,
+                    help="report how long loading and setting up took, and "
+                    "exit instead of running")
+    options, args = parser.parse_args()
+
+    initLog()
+    # Amarok runs the script in its own directory, so that's where it keeps
+    # its state. From the commandline that would litter the caller's
+    # directory, so it goes in ~/.amakode instead.
+    amarok = not (args or options.daemon or options.sync or
+        options.benchmark or options.test or options.status or
+        options.list_tools)
+    if amarok:
+        statedir = os.getcwd()
+    else:
+        statedir = os.path.expanduser(os.path.join("~", ".amakode"))
+
+    def state_file(name):
+        if not os.path.isdir(statedir):
+            os.makedirs(statedir, 0700)
+        return os.path.join(statedir, name)
+    if options.cache and options.cache_dir is None:
+        options.cache_dir = state_file('amakode-cache')
+    if options.use_index and options.index is None:
+        options.index = state_file('amakode-index.db')
+    if options.socket is None and not amarok:
+        options.socket = state_file('amakode.sock')
+    if options.journal == "":
+        options.journal = state_file('amakode-journal')
+
+    if options.cache:
+        TranscodeJob.cache = TranscodeCache(options.cache_dir,
+            options.cache_size * 1024 * 1024, options.cache_hash)
+    if options.use_index:
+        TranscodeJob.index = LibraryIndex(options.index)
+    QueueMgr.stats = JobStats(options.stats_file)
+    if options.journal:
+        QueueMgr.journal = JobJournal(options.journal)
+    TranscodeJob.copy_same_codec = options.copy
+    TranscodeJob.max_copy_bitrate = options.max_copy_bitrate
+    TranscodeJob.pipe_size = options.pipe_size * 1024
+    SplitJob.split_over = options.split_over
+    TranscodeJob.pipe_buffer = options.pipe_buffer * 1024
+    if options.adaptive:
+        QueueMgr.controller = LoadController(options.min_jobs,
+            options.max_jobs or 2 * number_of_processors())
+    if options.nice or options.ionice or options.cgroup:
+        TranscodeJob.limits = ChildLimits(options.nice,
+            {None: None, "best-effort": 2, "idle": 3}[options.ionice],
+            options.cgroup)
+    signal.signal(signal.SIGINT, onStop)
+    signal.signal(signal.SIGHUP, onHangup)
+    signal.signal(signal.SIGTERM, onStop)
+
+    if options.profile_startup:
+        if amarok:
+            amaKode()
+        profile_startup(launched or loadtime, setup_start)
+    elif options.list_tools:
+        list_tools()
+    elif options.status:
+        daemon_status(options)
+    elif options.daemon:
+        Daemon(options).run()
+    elif options.benchmark:
+        benchmark(options)
+    elif options.test:
+        quick_test()
+    elif options.sync:
+        sync(options, args)
+    elif args:
+        process_cmdline(options, args)
+    else:
+        # Run normal application
+        app = amaKode()
+        try:
+            app.run()
+        except Exception:
+            log.exception("Exception caught in main program")
+
+
+def process_age():
+    """Return how many seconds ago this process started, to the nearest
+    clock tick, or None if there's no /proc to ask"""
+    try:
+        uptime = float(open("/proc/uptime").read().split()[0])
+        stat = open("/proc/self/stat").read()
+    except (IOError, ValueError):
+        return None
+    # the fields after the command name, which may contain spaces, start
+    # with the third; the start time is the 22nd
+    started = int(stat[stat.rindex(")") + 2:].split()[19])
+    return uptime - started / float(os.sysconf('SC_CLK_TCK'))
+
+
+def profile_startup(launched, setup_start):
+    """Print where the time and memory went before amaKode could start
+    work, from when the process started"""
+    now = time.time()
+    age = process_age()
+    if age is not None:
+        print "Python:   %6.1f ms" % ((launched - (now - age)) * 1000)
+    print "Loading:  %6.1f ms" % ((setup_start - launched) * 1000)
+    print "Setup:    %6.1f ms" % ((now - setup_start) * 1000)
+    if age is not None:
+        print "Total:    %6.1f ms" % (age * 1000)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    print "CPU:      %6.1f ms" % ((usage.ru_utime + usage.ru_stime) * 1000)
+    print "Modules:  %6d" % len(sys.modules)
+    print "Max RSS:  %6d KiB" % usage.ru_maxrss
+    lazy = [name for name, module in globals().items()
+            if isinstance(module, LazyModule) and module._module]
+    lazy.sort()
+    print "Lazily loaded: " + (", ".join(lazy) or "none")
+
+
+def process_cmdline(options, args, sources=None, on_result=None):
+    """Transcode the files named in args, or the (filename, [destination for
+    each format]) pairs from sources if it is given. on_result is called with
+    the filename, destination and error message of each output."""
+    stats = {'files': 0, 'failed': 0, 'audio': 0.0}
+    destinations = {}
+
+    formats = options.format.split(",")
+    if sources is None:
+        sources = cmdline_outputs(options, args, formats)
+
+    def report(source, dest, errormsg, elapsed, length):
+        if on_result is not None:
+            on_result(source, dest, errormsg)
+        stats['files'] += 1
+        if errormsg:
+            stats['failed'] += 1
+            print "%s -> %s: failed: %s" % (source, dest, errormsg)
+        elif length:
+            stats['audio'] += length
+            print "%s -> %s (%.1fs, %.1fx realtime)" % (source, dest,
+                elapsed, length / max(elapsed, 0.001))
+        else:
+            print "%s -> %s (%.1fs)" % (source, dest, elapsed)
+
+    def jobs():
+        for filename, dests in sources:
+            if done_already(dests):
+                log.debug("skipping " + filename + ", it was done already")
+                continue
+            url = "file:" + urllib.pathname2url(filename)
+            job, outputs = new_job(url, formats)
+            for output, dest in zip(outputs, dests):
+                set_destination(output, dest, destinations)
+            yield job
+
+    def finished(job):
+        log.debug('FINISHED %r, errormsg=%s' % (job, job.errormsg))
+        for output, dest, errormsg in publish_outputs(job, destinations):
+            # a job which failed early never set its infname
+            source = urllib.url2pathname(urlparse.urlsplit(output.inurl)[2])
+            elapsed = length = None
+            if not errormsg:
+                elapsed = output.endtime - output.starttime
+                length = output.audio_length()
+            report(source, dest, errormsg, elapsed, length)
+        job.clean_up()
+
+    start = time.time()
+    client = None
+    if options.use_daemon:
+        client = daemon_connect(options.socket)
+    if client is not None:
+        log.debug("handing the jobs to the daemon at " + options.socket)
+        run_in_daemon(client, sources, formats, report,
+            client_settings(options))
+    else:
+        q = QueueMgr(finished, options.jobs)
+        # outputs finished before a crash, and those to be resumed now
+        skip = set()
+        if q.journal is not None:
+            skip = q.journal.finished_outputs()
+        for output in resume_jobs(q, destinations):
+            skip.add(output.dest)
+
+        def done_already(dests):
+            for dest in dests:
+                if dest not in skip:
+                    return False
+            return True
+        q.add_lazily(jobs())
+        while not q.isidle():
+            q.poll()
+            if not q.isidle():
+                q.wait()
+    elapsed = max(time.time() - start, 0.001)
+    print "%d files (%d failed) in %.1fs: %.2f files/s, " \
+        "%.1f audio seconds/s" % (stats['files'], stats['failed'], elapsed,
+        stats['files'] / elapsed, stats['audio'] / elapsed)
+    log.debug('FINSIHED!')
+
+
+def sync(options, args):
+    """Mirror the directory args[0] into args[1]. Only new and changed files
+    are transcoded, and outputs whose source has gone are deleted."""
+    if len(args) != 2 or not os.path.isdir(args[0]):
+        sys.exit("--sync needs a source directory and a destination")
+    src, dest = args
+    src = src.rstrip(os.sep) or os.sep
+    formats = options.format.split(",")
+    manifest = SyncManifest(os.path.join(dest, SyncManifest.filename))
+    settings = "\0".join([" ".join([tofmt] + TranscodeJob.encode.get(tofmt, []))
+        for tofmt in formats])
+    counts = {'current': 0, 'removed': 0}
+    seen = set()
+    # source filename -> [relative name, stat, outputs, outputs not done yet,
+    # failed]
+    pending = {}
+
+    def sources():
+        for filename, relname in find_sources([src], True):
+            relname = filename[len(src):].lstrip(os.sep)
+            seen.add(relname)
+            outputs = [os.path.splitext(relname)[0] + "." + tofmt
+                for tofmt in formats]
+            dests = [os.path.join(dest, output) for output in outputs]
+            st = os.stat(filename)
+            if manifest.current(relname, st, settings, outputs):
+                counts['current'] += 1
+                continue
+            pending[filename] = [relname, st, outputs, len(dests), False]
+            yield filename, dests
+
+    def on_result(filename, output, errormsg):
+        if filename not in pending:
+            # a job resumed from the journal, not one of ours
+            return
+        entry = pending[filename]
+        entry[3] -= 1
+        entry[4] = entry[4] or bool(errormsg)
+        if entry[3] == 0:
+            del pending[filename]
+            if not entry[4]:
+                manifest.update(entry[0], entry[1], settings, entry[2])
+
+    try:
+        process_cmdline(options, [], sources(), on_result)
+        for relname in manifest.sources():
+            if relname in seen or \
+                    os.path.exists(os.path.join(src, relname)):
+                continue
+            for output in manifest.remove(relname):
+                filename = os.path.join(dest, output)
+                print "removing " + filename
+                try:
+                    os.unlink(filename)
+                    counts['removed'] += 1
+                except OSError:
+                    pass
+                remove_empty_dirs(os.path.dirname(filename), dest)
+    finally:
+        manifest.save()
+    print "%d files already up to date, %d removed" % (counts['current'],
+        counts['removed'])
+
+
+def remove_empty_dirs(path, top):
+    """Remove path and its parents, up to but not including top, while they
+    are empty"""
+    top = os.path.abspath(top)
+    path = os.path.abspath(path)
+    while path != top and path.startswith(top + os.sep):
+        try:
+            os.rmdir(path)
+        except OSError:
+            break
+        path = os.path.dirname(path)
+
+
+def cmdline_outputs(options, args, formats):
+    """Generate (source filename, [destination for each format]) for the
+    commandline arguments args"""
+    for filename, relname in find_sources(args, options.recursive):
+        dests = []
+        for tofmt in formats:
+            if options.output_dir:
+                dest = os.path.join(options.output_dir,
+                    os.path.splitext(relname)[0] + "." + tofmt)
+            else:
+                dest = os.path.splitext(filename)[0] + "." + tofmt
+            dests.append(dest)
+        yield filename, dests
+
+
+def new_job(url, formats, split_over=None):
+    """Return a job transcoding url to each of formats, and the TranscodeJob
+    for each format. split_over overrides SplitJob.split_over."""
+    if split_over is None:
+        split_over = SplitJob.split_over
+    if len(formats) > 1:
+        job = FanoutJob(url, formats)
+        return job, job.jobs
+    if split_over and formats[0].lower() in SplitJob.frame_samples:
+        job = SplitJob(url, formats[0])
+    else:
+        job = TranscodeJob(url, formats[0])
+    return job, [job]
+
+
+def set_destination(output, dest, destinations):
+    """Arrange for output to be written next to dest, its final name"""
+    destinations[output] = dest
+    output.dest = dest
+    output.outdir = os.path.dirname(dest) or os.curdir
+    if not os.path.isdir(output.outdir):
+        os.makedirs(output.outdir)
+
+
+def resume_jobs(queue, destinations):
+    """Queue the jobs left unfinished in the queue's journal by an earlier
+    run, publishing their outputs to the destinations they had. Returns the
+    output of each job queued.
+
+    If destinations is None the caller doesn't publish outputs (Amarok
+    picks them up itself), so only the jobs without destinations are
+    resumed. Otherwise only the jobs with them are; the rest are left in
+    the journal for a caller which can finish them.
+    """
+    resumed = []
+    if queue.journal is None:
+        return resumed
+    for jid, added, url, outputs in queue.journal.pending():
+        formats = [tofmt for tofmt, dest in outputs]
+        dests = [dest for tofmt, dest in outputs]
+        if (destinations is None) != (None in dests or "" in dests):
+            continue
+        finished = True
+        for dest in dests:
+            if not dest or not os.path.exists(dest) or \
+                    os.path.getmtime(dest) < added:
+                finished = False
+        if finished:
+            log.debug("%s was finished before the restart" % url)
+            queue.journal.finished(jid, True)
+            continue
+        log.debug("resuming " + url)
+        job, jobs = new_job(url, formats)
+        job.journal_id = jid
+        if destinations is not None:
+            for output, dest in zip(jobs, dests):
+                set_destination(output, dest, destinations)
+        queue.add(job)
+        resumed.extend(jobs)
+    return resumed
+
+
+def publish_outputs(job, destinations):
+    """Move each successful output of the finished job to its destination
+    in destinations. Returns (output, destination, error message) for each
+    output which has a destination."""
+    if isinstance(job, FanoutJob):
+        outputs = job.jobs
+    else:
+        outputs = [job]
+    results = []
+    for output in outputs:
+        dest = destinations.pop(output, None)
+        if dest is None:
+            log.debug("%r has nowhere to go" % output)
+            continue
+        errormsg = job.errormsg or output.errormsg
+        if not errormsg:
+            try:
+                output.publish(dest)
+            except (IOError, OSError):
+                errormsg = str(sys.exc_info()[1])
+        results.append((output, dest, errormsg))
+    return results
+
+
+# TranscodeJob attributes a commandline client has the daemon set for its
+# jobs, so that they're done as if the client had run them itself
+job_settings = ("copy_same_codec", "max_copy_bitrate", "cache", "split_over",
+    "pipe_size", "pipe_buffer")
+
+
+def client_settings(options):
+    """Return the name=value fields of a settings request giving the daemon
+    the job settings from the commandline options"""
+    values = {
+        "copy_same_codec": int(options.copy),
+        "max_copy_bitrate": options.max_copy_bitrate,
+        "cache": int(options.cache),
+        "split_over": options.split_over,
+        "pipe_size": options.pipe_size * 1024,
+        "pipe_buffer": options.pipe_buffer * 1024,
+        "jobs": options.jobs,
+    }
+    fields = []
+    for name, value in values.items():
+        if value is None:
+            value = ""
+        fields.append("%s=%s" % (name, value))
+    fields.sort()
+    return fields
+
+
+def parse_settings(fields):
+    """Return the settings in the name=value fields from client_settings()
+    as a dictionary, with None for the empty values. Raises ValueError if
+    any of them can't be read."""
+    settings = {}
+    for field in fields:
+        name, value = field.split("=", 1)
+        if name not in job_settings and name != "jobs":
+            raise ValueError("unknown setting " + name)
+        if value:
+            settings[name] = int(value)
+        else:
+            settings[name] = None
+    return settings
+
+
+def apply_settings(job, settings):
+    """Have job, and the job for each of its outputs, use the job settings
+    from parse_settings() instead of the defaults"""
+    jobs = [job]
+    if isinstance(job, FanoutJob):
+        jobs += job.jobs
+    for each in jobs:
+        for name in job_settings:
+            if name not in settings:
+                continue
+            if name == "cache":
+                # a client can only turn the daemon's cache off
+                if not settings[name]:
+                    each.cache = None
+            else:
+                setattr(each, name, settings[name])
+
+
+def daemon_connect(path):
+    """Return a socket connected to the daemon listening at path, or None if
+    there isn't one. Exits if someone else could have put it there, rather
+    than hand them our jobs."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if st.st_uid != os.getuid() or st.st_mode & 022:
+        sys.exit("Refusing to use %s, which isn't private to you" % path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error, e:
+        log.debug("no daemon at %s: %s" % (path, e))
+        sock.close()
+        return None
+    return sock
+
+
+def join_fields(fields):
+    """Return a line of tab separated fields, escaped like python strings"""
+    return "\t".join([f.encode('string_escape') for f in fields]) + "\n"
+
+
+def split_fields(line):
+    """Return the fields of a line from join_fields()"""
+    return [f.decode('string_escape') for f in line.rstrip("\n").split("\t")]
+
+
+def send_request(sock, *fields):
+    """Send a line of tab separated fields to the other end of sock"""
+    sock.sendall(join_fields(fields))
+
+
+def read_replies(sock):
+    """Generate the lists of fields sent by the other end of sock"""
+    for line in sock.makefile('rb'):
+        yield split_fields(line)
+
+
+def run_in_daemon(sock, sources, formats, report, settings):
+    """Have the daemon connected to sock transcode the (filename,
+    destinations) pairs from sources with the job settings from
+    client_settings(), calling report() with each result"""
+    names = {}
+
+    def send():
+        try:
+            try:
+                send_request(sock, "settings", *settings)
+                for filename, dests in sources:
+                    url = "file:" + urllib.pathname2url(
+                        os.path.abspath(filename))
+                    fields = ["transcode", url]
+                    for tofmt, dest in zip(formats, dests):
+                        names[os.path.abspath(dest)] = (filename, dest)
+                        fields += [tofmt, os.path.abspath(dest)]
+                    send_request(sock, *fields)
+            except Exception:
+                log.exception("Failed to send jobs to the daemon")
+        finally:
+            # ask for a reply once every job sent has finished
+            send_request(sock, "wait")
+
+    sender = threading.Thread(target=send)
+    sender.setDaemon(True)
+    sender.start()
+    for fields in read_replies(sock):
+        if fields[0] == "idle":
+            break
+        if fields[0] in ("warning", "error"):
+            print "daemon: " + " ".join(fields[1:])
+            continue
+        if fields[0] != "done":
+            log.debug("unexpected reply from the daemon: %r" % fields)
+            continue
+        filename, dest = names.pop(fields[1])
+        if fields[2] == "ok":
+            report(filename, dest, None, float(fields[3]),
+                float(fields[4]) or None)
+        else:
+            report(filename, dest, fields[3], None, None)
+    sock.close()
+
+
+def daemon_status(options):
+    sock = daemon_connect(options.socket)
+    if sock is None:
+        print "No daemon is running at " + options.socket
+        return
+    send_request(sock, "status")
+    for fields in read_replies(sock):
+        print " ".join(fields[1:])
+        break
+    sock.close()
+
+
+def find_sources(args, recursive):
+    """Generate (filename, relative name) for each file named in args.
+
+    Arguments may be glob patterns. Directories are walked when recursive
+    is set, and only files we know how to decode are returned from them;
+    the relative name is then the path below that directory.
+    """
+    for arg in args:
+        if glob.has_magic(arg):
+            matches = glob.glob(arg)
+            matches.sort()
+        else:
+            matches = [arg]
+        for path in matches:
+            if not os.path.isdir(path):
+                yield path, os.path.basename(path)
+            elif not recursive:
+                log.debug("skipping directory " + path + " (use -r)")
+            else:
+                root = os.path.dirname(path.rstrip(os.sep))
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirnames.sort()
+                    filenames.sort()
+                    for name in filenames:
+                        ext = os.path.splitext(name)[1].lstrip('.').lower()
+                        if ext not in TranscodeJob.decode:
+                            continue
+                        filename = os.path.join(dirpath, name)
+                        yield filename, filename[len(root):].lstrip(os.sep)
+
+
+def list_tools():
+    names = set()
+    for command in TranscodeJob.decode.values() + \
+            TranscodeJob.encode.values():
+        names.add(command[program_index(command)])
+    names.add('AtomicParsley')
+    names = list(names)
+    names.sort()
+    for name in names:
+        path = tools.find(name)
+        if path:
+            print "%-15s %s (%s)" % (name, path, tools.version(name))
+        else:
+            print "%-15s not found" % name
+
+
+def benchmark(options):
+    """Transcode generated audio with every decoder and encoder pair at
+    various numbers of concurrent jobs, and print the timings as JSON"""
+
+    if not json:
+        print "The benchmark needs the json or simplejson module."
+        return
+    QueueMgr.journal = None
+    if options.benchmark_jobs:
+        levels = [int(n) for n in options.benchmark_jobs.split(",")]
+    else:
+        levels = list(set([1, number_of_processors()]))
+        levels.sort()
+    length = options.benchmark_length
+    nfiles = 2 * max(levels)
+
+    # always do the work we're timing
+    TranscodeJob.cache = None
+    TranscodeJob.index = None
+    TranscodeJob.copy_same_codec = False
+
+    workdir = tempfile.mkdtemp(prefix="amakode-benchmark-")
+    try:
+        sources = {"wav": []}
+        for i in range(nfiles):
+            filename = os.path.join(workdir, "%d.wav" % i)
+            make_tone(filename, length, 220 + 110 * i)
+            sources["wav"].append(filename)
+        formats = TranscodeJob.decode.keys()
+        formats.sort()
+        for fmt in formats:
+            if fmt != "wav":
+                sources[fmt] = make_fixtures(sources["wav"], fmt)
+
+        results = []
+        for inext in formats:
+            encodings = TranscodeJob.encode.keys()
+            encodings.sort()
+            for tofmt in encodings:
+                for jobs in levels:
+                    result = {"decode": inext, "encode": tofmt, "jobs": jobs}
+                    try:
+                        TranscodeJob("file:x." + inext, tofmt).check_codecs()
+                        if not sources[inext]:
+                            raise KeyError("unable to make " + inext +
+                                " files to decode")
+                    except KeyError:
+                        result["skipped"] = str(sys.exc_info()[1])
+                    else:
+                        result.update(benchmark_case(sources[inext], tofmt,
+                            jobs, length))
+                    results.append(result)
+    finally:
+        shutil.rmtree(workdir, True)
+
+    print json.dumps({"version": __version__, "cpus": number_of_processors(),
+        "length": length, "files": nfiles, "results": results}, indent=2)
+
+
+def make_tone(filename, length, frequency):
+    """Write length seconds of a stereo sine wave to the WAV file filename"""
+
+    rate = 44100
+    samples = []
+    for i in range(rate):
+        sample = int(16000 * math.sin(2 * math.pi * frequency * i / rate))
+        samples += [sample, sample]
+    second = struct.pack("<%dh" % len(samples), *samples)
+    w = wave.open(filename, "wb")
+    try:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        for i in range(length):
+            w.writeframes(second)
+    finally:
+        w.close()
+
+
+# Commands to make files for benchmarking formats we can't encode
+fixture_encode = {
+    "flac": ["flac", "--silent", "-c", "-"],
+}
+
+
+def make_fixtures(wavs, fmt):
+    """Encode each of the WAV files wavs to fmt, returning the new files or
+    an empty list if we can't"""
+
+    command = TranscodeJob.encode.get(fmt) or fixture_encode.get(fmt)
+    if not command or not tools.find(command[program_index(command)]):
+        return []
+    command = tools.resolve(command)
+    fixtures = []
+    for wav in wavs:
+        filename = os.path.splitext(wav)[0] + "." + fmt
+        infh = open(wav, "rb")
+        outfh = open(filename, "wb")
+        try:
+            rtn = subprocess.call(command, stdin=infh, stdout=outfh)
+        finally:
+            infh.close()
+            outfh.close()
+        if rtn != 0:
+            log.debug("unable to make " + fmt + " files to benchmark")
+            return []
+        fixtures.append(filename)
+    return fixtures
+
+
+def benchmark_case(sources, tofmt, jobs, length):
+    """Transcode the files sources to tofmt running jobs at a time, and
+    return a dict of measurements.
+
+    This runs in a child process so that the resource usage of the
+    decoders and encoders can be measured separately for each case.
+    """
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            try:
+                result = run_benchmark_case(sources, tofmt, jobs, length)
+                os.write(w, marshal.dumps(result))
+            except Exception:
+                log.exception("Benchmark failed")
+        finally:
+            os._exit(0)
+    os.close(w)
+    data = ""
+    while True:
+        chunk = os.read(r, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(r)
+    os.waitpid(pid, 0)
+    if not data:
+        return {"error": "benchmark failed, see the log"}
+    return marshal.loads(data)
+
+
+def run_benchmark_case(sources, tofmt, jobs, length):
+    failed = []
+
+    def finished(job):
+        if job.errormsg:
+            failed.append(job.errormsg)
+        else:
+            os.unlink(job.outfname)
+        job.clean_up()
+
+    start = time.time()
+    q = QueueMgr(finished, jobs)
+    for filename in sources:
+        q.add(TranscodeJob("file:" + urllib.pathname2url(filename), tofmt))
+    while not q.isidle():
+        q.poll()
+        if not q.isidle():
+            q.wait()
+    wall = time.time() - start
+
+    # make sure the decoders are counted in the children's usage
+    try:
+        while True:
+            os.wait()
+    except OSError:
+        pass
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    scheduler = me.ru_utime + me.ru_stime
+    result = {
+        "failed": len(failed),
+        "wall_seconds": wall,
+        "realtime_factor": len(sources) * length / wall,
+        "cpu_seconds": children.ru_utime + children.ru_stime,
+        "peak_rss_kb": children.ru_maxrss,
+        "scheduler_cpu_seconds": scheduler,
+        "scheduler_overhead": scheduler / wall,
+    }
+    if failed:
+        result["error"] = failed[0]
+    return result
+
+
+def quick_test():
+    # Quick test case
+    problems = check_tag_writers()
+    for problem in problems:
+        print "tag check failed: " + problem
+    if not problems:
+        print "tag checks passed"
+
+    def reportJob(job):
+        log.debug('FINISHED %r, errormsg=%s' % (job, job.errormsg))
+        job.clean_up()
+    q = QueueMgr(reportJob)
+    j1 = TranscodeJob("file:test/test1.m4a", "ogg")
+    q.add(j1)
+    j2 = TranscodeJob("file:test/test2.mp3", "ogg")
+    q.add(j2)
+    while not q.isidle():
+        q.poll()
+        if not q.isidle():
+            q.wait()
+    log.debug("jobs all done")
+
+
+def check_tag_writers():
+    """Write tags into small files laid out like each encoder's output, read
+    them back, and check that nothing else moved; then join some mp3
+    segments and check the Xing/Info frame. Returns a list of what went
+    wrong."""
+
+    class Tags(dict):
+        allfields = tagpywrap.allfields
+    tags = Tags(album=u'Album', artist=u'Art\xefst \u263a', title=u'Title',
+        comment=u'Comment', genre=u'Genre', year=1999, track=7)
+    tags['picture'] = ('image/png', '\x89PNG\r\n\x1a\n' + 'P' * 3000)
+    mp3frame = '\xff\xfb\x90\x64' + 'M' * 413
+    audio = mp3frame * 4
+
+    def flac_block(btype, body):
+        return chr(btype) + struct.pack(">I", len(body))[1:] + body
+
+    def ogg_page(flags, sequence, packets):
+        lacing = ""
+        for packet in packets:
+            lacing += '\xff' * (len(packet) // 255) + chr(len(packet) % 255)
+        header = 'OggS\0' + chr(flags) + struct.pack("<qIII", 0, 1,
+            sequence, 0) + chr(len(lacing)) + lacing
+        body = "".join(packets)
+        return header[:22] + struct.pack("<I", ogg_crc(header + body)) + \
+            header[26:] + body
+
+    def ogg_pages_ok(data):
+        pos = 0
+        while pos < len(data):
+            header = data[pos:pos + 27 + ord(data[pos + 26])]
+            end = pos + len(header) + sum([ord(c) for c in header[27:]])
+            body = data[pos + len(header):end]
+            if struct.unpack("<I", header[22:26])[0] != ogg_crc(
+                    header[:22] + '\0\0\0\0' + header[26:] + body):
+                return False
+            pos = end
+        return True
+
+    def id3_read(fh):
+        fields = dict([(fid, field)
+            for field, fid in id3_text_frames.items()])
+        found = {}
+        for fid, body in id3_frames(fh):
+            codec = {'\0': 'latin1', '\x01': 'utf16'}[body[0]]
+            if fid == 'COMM':
+                found['comment'] = body[4:].split('\0', 1)[1].decode(codec)
+            elif fid in fields:
+                found[fields[fid]] = body[1:].decode(codec)
+        return found
+
+    def vorbis_read(comments):
+        fields = dict([(name, field)
+            for field, name in vorbis_fields.items()])
+        found = {}
+        for comment in comments:
+            name, value = comment.split("=", 1)
+            if name in fields:
+                found[fields[name]] = value.decode('utf8')
+        return found
+
+    def flac_read(fh):
+        for btype, offset, length in flac_blocks(fh)[0]:
+            if btype == 4:
+                fh.seek(offset)
+                return vorbis_read(unpack_vorbis_comment(fh.read(length))[1])
+        return {}
+
+    def ogg_read(fh):
+        return vorbis_read(unpack_vorbis_comment(
+            ogg_vorbis_headers(fh)[0][1][7:])[1])
+
+    def mp4_read(fh):
+        return mp4wrap(fh.name)
+
+    vendor = pack_vorbis_comment('amaKode', [vorbis_padding + '=' + '.' * 8000])
+    moov = mp4_atom('moov', mp4_atom('mvhd', '\0' * 100))
+    ftyp = mp4_atom('ftyp', 'M4A \0\0\0\0M4A mp42isom')
+    cases = [
+        ("mp3", "mp3", id3_read,
+            'ID3\x03\0\0' + syncsafe(8000) + '\0' * 8000 + audio),
+        ("flac", "flac", flac_read, 'fLaC' + flac_block(0, '\0' * 34) +
+            flac_block(4, pack_vorbis_comment('libFLAC', [])) +
+            flac_block(0x81, '\0' * 8000) + audio),
+        ("ogg", "ogg", ogg_read,
+            ogg_page(2, 0, ['\x01vorbis' + '\0' * 23]) +
+            ogg_page(0, 1, ['\x03vorbis' + vendor + '\x01',
+                '\x05vorbis' + 'S' * 300]) +
+            ogg_page(4, 2, [audio])),
+        ("mp4 with moov first", "mp4", mp4_read, ftyp + moov +
+            mp4_atom('free', '\0' * 8000) + mp4_atom('mdat', audio)),
+        ("mp4 with moov last", "m4a", mp4_read,
+            ftyp + mp4_atom('mdat', audio) + moov),
+    ]
+    problems = []
+    # jobs only read the source's tags for the formats in tagopt
+    for fmt in tag_writers:
+        if fmt not in TranscodeJob.tagopt:
+            problems.append(fmt + ": tags are never read for it")
+    tmpdir = tempfile.mkdtemp(prefix="amakode-check-")
+    try:
+        for name, fmt, read, data in cases:
+            filename = os.path.join(tmpdir, "check." + fmt)
+            open(filename, 'wb').write(data)
+            try:
+                if not write_tags(filename, fmt, tags):
+                    problems.append(name + ": no room for the tags")
+                    continue
+                fh = open(filename, 'rb')
+                try:
+                    found = read(fh)
+                    fh.seek(0)
+                    written = fh.read()
+                finally:
+                    fh.close()
+                for field in tags.allfields:
+                    if found.get(field) != tags[field] and \
+                            found.get(field) != tag_text(tags[field]):
+                        problems.append("%s: %s is %r" % (name, field,
+                            found.get(field)))
+                if read_picture(filename, fmt) != tags['picture']:
+                    problems.append(name + ": the picture didn't survive")
+                if written.find(audio) != data.find(audio):
+                    problems.append(name + ": the audio moved")
+                if fmt == "ogg" and not ogg_pages_ok(written):
+                    problems.append(name + ": bad page checksum")
+            except Exception:
+                problems.append("%s: %s" % (name, sys.exc_info()[1]))
+
+        def frame(number, index):
+            return mp3frame[:4] + chr(number * 16 + index) * 413
+
+        def segment(number, frames, delay, padding):
+            lame = 'LAME3.100' + '\0' * 12 + \
+                struct.pack(">I", (delay << 12) | padding)[1:] + '\0' * 12
+            info = mp3frame[:4] + '\0' * 32 + 'Info' + \
+                struct.pack(">III", 15, frames, 0) + '\0' * 104 + lame
+            return info + '\0' * (len(mp3frame) - len(info)) + \
+                "".join([frame(number, i) for i in range(frames)])
+        # the segments overlap by a frame, as SplitJob's do
+        trims = [(0, 2), (1, 1), (1, None)]
+        filenames = []
+        for number, frames, padding in ((0, 3, 1000), (1, 3, 1001),
+                (2, 2, 1002)):
+            filenames.append(os.path.join(tmpdir, "segment%d.mp3" % number))
+            open(filenames[-1], 'wb').write(segment(number, frames, 576,
+                padding))
+        fd, filename = tempfile.mkstemp(suffix=".mp3", dir=tmpdir)
+        try:
+            join_mp3(filenames, fd, trims)
+        finally:
+            os.close(fd)
+        data = open(filename, 'rb').read()
+        info = data[:len(mp3frame)]
+        xing = xing_fields(info)
+        if data[len(info):] != frame(0, 0) + frame(0, 1) + frame(1, 1) + \
+                frame(2, 1):
+            problems.append("join_mp3: the wrong frames were kept")
+        if xing is None or xing[0] != 'Info':
+            problems.append("join_mp3: no Info frame")
+        else:
+            fields = xing[1]
+            if struct.unpack(">II", info[fields[0]:fields[0] + 8]) != \
+                    (4, len(data)):
+                problems.append("join_mp3: wrong frame or byte count")
+            if lame_delay(info) != (576, 1002):
+                problems.append("join_mp3: delay and padding are %r" %
+                    (lame_delay(info),))
+            crcat = fields[4] + 34
+            if crc16(info[:crcat]) != \
+                    struct.unpack(">H", info[crcat:crcat + 2])[0]:
+                problems.append("join_mp3: bad LAME tag CRC")
+    finally:
+        shutil.rmtree(tmpdir)
+    return problems
+
+
+def get_tags(filename, ext):
+    # list of mp4 extensions to read ourselves or with atomicparsley
+    # (tagpy seems to silently die on mp4/m4a files)
+    mp4_ext = ("mp4", "m4a")
+
+    if ext in mp4_ext:
+        try:
+            return mp4wrap(filename)
+        except Exception:
+            log.exception("Unable to read tags from " + filename)
+        if tools.find('AtomicParsley'):
+            return atomicparsleywrap(filename)
+        else:
+            notify_missing_package('AtomicParsley', ext,
+                'atomicparsley', 'atomicparsley')
+            return None
+    else:
+        if tagpy:
+            return tagpywrap(filename)
+        else:
+            notify_missing_package('TagPy', ext, 'python-tagpy', 'tagpy')
+            return None
+
+
+# ID3v1 genres, as used by the mp4 gnre atom (which counts from 1)
+id3_genres = ["Blues", "Classic Rock", "Country", "Dance", "Disco", "Funk",
+    "Grunge", "Hip-Hop", "Jazz", "Metal", "New Age", "Oldies", "Other", "Pop",
+    "R&B", "Rap", "Reggae", "Rock", "Techno", "Industrial", "Alternative",
+    "Ska", "Death Metal", "Pranks", "Soundtrack", "Euro-Techno", "Ambient",
+    "Trip-Hop", "Vocal", "Jazz+Funk", "Fusion", "Trance", "Classical",
+    "Instrumental", "Acid", "House", "Game", "Sound Clip", "Gospel", "Noise",
+    "AlternRock", "Bass", "Soul", "Punk", "Space", "Meditative",
+    "Instrumental Pop", "Instrumental Rock", "Ethnic", "Gothic", "Darkwave",
+    "Techno-Industrial", "Electronic", "Pop-Folk", "Eurodance", "Dream",
+    "Southern Rock", "Comedy", "Cult", "Gangsta", "Top 40", "Christian Rap",
+    "Pop/Funk", "Jungle", "Native American", "Cabaret", "New Wave",
+    "Psychadelic", "Rave", "Showtunes", "Trailer", "Lo-Fi", "Tribal",
+    "Acid Punk", "Acid Jazz", "Polka", "Retro", "Musical", "Rock & Roll",
+    "Hard Rock"]
+
+
+class mp4wrap(dict):
+    """Read tags straight from the moov/udta/meta/ilst atoms of an mp4 file.
+
+    Only the atom headers on the way to ilst are read; everything else is
+    skipped with seeks, so this is much cheaper than running AtomicParsley.
+    """
+    textfields = ['album', 'artist', 'title', 'comment', 'genre']
+    textatoms = ['\xa9alb', '\xa9ART', '\xa9nam', '\xa9cmt', '\xa9gen']
+    numfields = ['year', 'track']
+    allfields = textfields + numfields
+
+    def __init__(self, filename):
+        log.debug("Reading mp4 tags from " + filename)
+        fh = open(filename, 'rb')
+        try:
+            fh.seek(0, 2)
+            ilst = find_atom(fh, 0, fh.tell(), ['moov', 'udta', 'meta', 'ilst'])
+            if ilst is None:
+                return
+            for name, start, end in mp4_atoms(fh, ilst[0], ilst[1]):
+                data = find_atom(fh, start, end, ['data'])
+                if data is None or data[1] - data[0] < 8:
+                    continue
+                # skip the type and locale fields of the data atom
+                fh.seek(data[0] + 8)
+                value = fh.read(data[1] - data[0] - 8)
+                self.add_atom(name, value)
+        finally:
+            fh.close()
+
+    def add_atom(self, name, value):
+        if name in self.textatoms:
+            field = self.textfields[self.textatoms.index(name)]
+            self[field] = unicode(value, 'utf8', 'replace').strip()
+            if not self[field]:
+                del self[field]
+        elif name == 'gnre' and len(value) >= 2:
+            genre = struct.unpack(">H", value[:2])[0]
+            if 0 < genre <= len(id3_genres) and 'genre' not in self:
+                self['genre'] = unicode(id3_genres[genre - 1])
+        elif name == '\xa9day':
+            try:
+                self['year'] = int(value[:4])
+            except ValueError:
+                pass
+        elif name == 'trkn' and len(value) >= 4:
+            track = struct.unpack(">H", value[2:4])[0]
+            if track:
+                self['track'] = track
+
+
+def mp4_atoms(fh, start, end):
+    """Return (type, payload start, end) for the atoms between start and end
+    of the file fh"""
+
+    atoms = []
+    pos = start
+    while pos + 8 <= end:
+        fh.seek(pos)
+        size, name = struct.unpack(">I4s", fh.read(8))
+        payload = pos + 8
+        if size == 1:
+            size = struct.unpack(">Q", fh.read(8))[0]
+            payload += 8
+        elif size == 0:
+            size = end - pos
+        if size < payload - pos or pos + size > end:
+            log.debug("corrupt mp4 atom at %d" % pos)
+            break
+        atoms.append((name, payload, pos + size))
+        pos += size
+    return atoms
+
+
+def find_atom(fh, start, end, path):
+    """Return (payload start, end) of the atom at path below start..end, or
+    None if there isn't one"""
+
+    for name, payload, atomend in mp4_atoms(fh, start, end):
+        if name != path[0]:
+            continue
+        if name == 'meta':
+            # meta is a full atom with a version and flags before its
+            # children, except in some QuickTime files
+            fh.seek(payload + 4)
+            if fh.read(4) != 'hdlr':
+                payload += 4
+        if len(path) == 1:
+            return payload, atomend
+        return find_atom(fh, payload, atomend, path[1:])
+    return None
+
+
+def tag_text(value):
+    """Return a tag value as unicode"""
+    if isinstance(value, unicode):
+        return value
+    return unicode(str(value))
+
+
+def image_mime(data):
+    """Guess the mime type of an image from its first few bytes"""
+    if data[:3] == '\xff\xd8\xff':
+        return 'image/jpeg'
+    if data[:8] == '\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if data[:4] == 'GIF8':
+        return 'image/gif'
+    return None
+
+
+def best_picture(pictures):
+    """Return the (mime type, data) of the front cover from a list of
+    (picture type, mime type, data), or any picture if there isn't one"""
+    for ptype, mime, data in pictures:
+        if ptype == 3:
+            return mime, data
+    if pictures:
+        return pictures[0][1], pictures[0][2]
+    return None
+
+
+def read_picture(filename, ext):
+    """Return the (mime type, data) of the cover art in filename, or None.
+    Only the tags at the start of the file are read."""
+    fh = open(filename, 'rb')
+    try:
+        if ext == "mp3":
+            pictures = id3_pictures(fh)
+        elif ext == "flac":
+            pictures = []
+            for btype, offset, length in flac_blocks(fh)[0]:
+                if btype == 6:
+                    fh.seek(offset)
+                    pictures.append(unpack_flac_picture(fh.read(length)))
+        elif ext == "ogg":
+            packets, pages = ogg_vorbis_headers(fh)
+            pictures = vorbis_pictures(unpack_vorbis_comment(
+                packets[1][7:])[1])
+        elif ext in ("mp4", "m4a"):
+            pictures = mp4_pictures(fh)
+        else:
+            pictures = []
+    finally:
+        fh.close()
+    return best_picture(pictures)
+
+
+def write_tags(filename, fmt, tags):
+    """Write tags into the encoded file filename, using the room the encoder
+    left for them so that none of the audio has to move. Return False if
+    there isn't enough room."""
+    log.debug("Writing %s tags to %s" % (fmt, filename))
+    fh = open(filename, 'r+b')
+    try:
+        return tag_writers[fmt](fh, tags)
+    finally:
+        fh.close()
+
+
+def tag_size(fmt, tags):
+    """Return roughly how many bytes tags will take in a file of format fmt,
+    not counting anything the encoder writes itself"""
+    if fmt == "mp3":
+        return len(id3_tag_frames(tags))
+    elif fmt == "flac":
+        size = len(pack_vorbis_comment("", vorbis_comments(tags))) + 8
+        if 'picture' in tags:
+            size += len(pack_flac_picture(tags['picture']))
+        return size
+    elif fmt == "ogg":
+        return len(pack_vorbis_comment("",
+            vorbis_comments(tags, with_picture=True)))
+    return len(mp4_ilst(tags))
+
+
+# ID3v2.3 frames for the text fields of the tags
+id3_text_frames = {
+    'album': 'TALB',
+    'artist': 'TPE1',
+    'title': 'TIT2',
+    'genre': 'TCON',
+    'year': 'TYER',
+    'track': 'TRCK',
+}
+
+
+def syncsafe(n):
+    """Return n as four 7 bit bytes"""
+    return "".join([chr((n >> shift) & 0x7f) for shift in (21, 14, 7, 0)])
+
+
+def unsyncsafe(data):
+    return ord(data[0]) << 21 | ord(data[1]) << 14 | ord(data[2]) << 7 | \
+        ord(data[3])
+
+
+def id3_size(header):
+    """Return the size of the ID3v2 tag starting with the 10 byte header, or
+    0 if header isn't the start of a tag"""
+    if header[:3] != "ID3" or len(header) < 10:
+        return 0
+    size = 10 + unsyncsafe(header[6:10])
+    if ord(header[5]) & 0x10:
+        # there's a footer too
+        size += 10
+    return size
+
+
+def id3_frames(fh):
+    """Return (frame id, data) for each frame of the ID3v2 tag at the start
+    of fh. Compressed and encrypted frames are left out."""
+    fh.seek(0)
+    header = fh.read(10)
+    size = id3_size(header)
+    if not size:
+        return []
+    major = ord(header[3])
+    flags = ord(header[5])
+    data = fh.read(unsyncsafe(header[6:10]))
+    if flags & 0x80 and major < 4:
+        data = data.replace('\xff\x00', '\xff')
+    pos = 0
+    if flags & 0x40 and major == 3:
+        pos = 4 + struct.unpack(">I", data[:4])[0]
+    elif flags & 0x40 and major == 4:
+        pos = unsyncsafe(data[:4])
+    if major == 2:
+        idlen, headlen = 3, 6
+    else:
+        idlen, headlen = 4, 10
+    frames = []
+    while pos + headlen <= len(data) and data[pos] != '\0':
+        fid = data[pos:pos + idlen]
+        if major == 2:
+            length = struct.unpack(">I", '\0' + data[pos + 3:pos + 6])[0]
+            fflags = 0
+        elif major == 3:
+            length, fflags = struct.unpack(">IH", data[pos + 4:pos + 10])
+        else:
+            length = unsyncsafe(data[pos + 4:pos + 8])
+            fflags = struct.unpack(">H", data[pos + 8:pos + 10])[0]
+        body = data[pos + headlen:pos + headlen + length]
+        pos += headlen + length
+        if major == 3:
+            if fflags & 0xc0:
+                continue
+            if fflags & 0x20:
+                # group id
+                body = body[1:]
+        elif major == 4:
+            if fflags & 0x0c:
+                continue
+            if fflags & 0x40:
+                body = body[1:]
+            if fflags & 0x01:
+                # data length indicator
+                body = body[4:]
+            if fflags & 0x02:
+                body = body.replace('\xff\x00', '\xff')
+        frames.append((fid, body))
+    return frames
+
+
+def id3_pictures(fh):
+    """Return (picture type, mime type, data) for each picture in the ID3v2
+    tag at the start of fh"""
+    pictures = []
+    for fid, body in id3_frames(fh):
+        if fid not in ('APIC', 'PIC') or len(body) < 4:
+            continue
+        encoding = ord(body[0])
+        if fid == 'PIC':
+            mime = {'JPG': 'image/jpeg', 'PNG': 'image/png'}.get(
+                body[1:4].upper())
+            pos = 4
+        else:
+            pos = body.find('\0', 1)
+            if pos == -1:
+                continue
+            mime = body[1:pos]
+            pos += 1
+        ptype = ord(body[pos:pos + 1] or '\0')
+        pos += 1
+        # skip the description
+        if encoding in (1, 2):
+            while pos < len(body) and body[pos:pos + 2] != '\0\0':
+                pos += 2
+            pos += 2
+        else:
+            pos = body.find('\0', pos) + 1
+        if not pos:
+            continue
+        data = body[pos:]
+        pictures.append((ptype, image_mime(data) or mime, data))
+    return pictures
+
+
+def id3_text(text):
+    """Return the encoding byte and the encoded text for an ID3v2.3 frame"""
+    try:
+        return '\0', text.encode('latin1')
+    except UnicodeError:
+        return '\x01', text.encode('utf16')
+
+
+def id3_tag_frames(tags):
+    """Return the ID3v2.3 frames holding tags"""
+    frames = []
+    for field in tags.allfields:
+        if field not in tags:
+            continue
+        encoding, text = id3_text(tag_text(tags[field]))
+        if field == 'comment':
+            # a comment has a language and an (empty) description
+            fid = 'COMM'
+            if encoding == '\0':
+                body = encoding + 'eng\0' + text
+            else:
+                body = encoding + 'eng\xff\xfe\0\0' + text
+        else:
+            fid = id3_text_frames[field]
+            body = encoding + text
+        frames.append(fid + struct.pack(">IH", len(body), 0) + body)
+    if 'picture' in tags:
+        mime, data = tags['picture']
+        # a front cover with no description
+        body = '\0' + mime + '\0\x03\0' + data
+        frames.append('APIC' + struct.pack(">IH", len(body), 0) + body)
+    return "".join(frames)
+
+
+def write_id3_tags(fh, tags):
+    """Replace the ID3v2 tag at the start of the mp3 file fh, which lame
+    padded out to make room"""
+    fh.seek(0)
+    size = id3_size(fh.read(10))
+    frames = id3_tag_frames(tags)
+    if not size or len(frames) > size - 10:
+        return False
+    fh.seek(0)
+    fh.write('ID3\x03\0\0' + syncsafe(size - 10) + frames +
+        '\0' * (size - 10 - len(frames)))
+    return True
+
+
+# Vorbis comment names of the fields of the tags
+vorbis_fields = {
+    'album': 'ALBUM',
+    'artist': 'ARTIST',
+    'title': 'TITLE',
+    'comment': 'COMMENT',
+    'genre': 'GENRE',
+    'year': 'DATE',
+    'track': 'TRACKNUMBER',
+}
+
+# The comment oggenc is given to make room for the tags
+vorbis_padding = 'AMAKODE_PADDING'
+
+
+def vorbis_comments(tags, with_picture=False):
+    """Return the "NAME=value" Vorbis comments holding tags. Ogg Vorbis
+    keeps the picture in a comment, but FLAC has a block for it."""
+    comments = []
+    for field in tags.allfields:
+        if field in tags:
+            comments.append(vorbis_fields[field] + "=" +
+                tag_text(tags[field]).encode('utf8'))
+    if with_picture and 'picture' in tags:
+        comments.append("METADATA_BLOCK_PICTURE=" +
+            base64.b64encode(pack_flac_picture(tags['picture'])))
+    return comments
+
+
+def replace_comments(comments, tags, with_picture=False):
+    """Return the Vorbis comments with any tags or padding replaced by
+    tags"""
+    replaced = set(vorbis_fields.values())
+    replaced.update(['METADATA_BLOCK_PICTURE', 'COVERART', 'COVERARTMIME',
+        vorbis_padding])
+    kept = [comment for comment in comments
+        if comment.split("=", 1)[0].upper() not in replaced]
+    return kept + vorbis_comments(tags, with_picture)
+
+
+def vorbis_pictures(comments):
+    """Return (picture type, mime type, data) for each picture in the Vorbis
+    comments"""
+    pictures = []
+    for comment in comments:
+        name, value = (comment.split("=", 1) + [""])[:2]
+        name = name.upper()
+        if name == 'METADATA_BLOCK_PICTURE':
+            pictures.append(unpack_flac_picture(base64.b64decode(value)))
+        elif name == 'COVERART':
+            # the old, unofficial way
+            data = base64.b64decode(value)
+            pictures.append((0, image_mime(data), data))
+    return pictures
+
+
+def pack_vorbis_comment(vendor, comments):
+    """Return a Vorbis comment header, without any framing"""
+    parts = [struct.pack("<I", len(vendor)), vendor,
+        struct.pack("<I", len(comments))]
+    for comment in comments:
+        parts.append(struct.pack("<I", len(comment)))
+        parts.append(comment)
+    return "".join(parts)
+
+
+def unpack_vorbis_comment(data):
+    """Return the vendor and the list of comments in a Vorbis comment
+    header"""
+    length = struct.unpack("<I", data[:4])[0]
+    vendor = data[4:4 + length]
+    pos = 4 + length
+    count = struct.unpack("<I", data[pos:pos + 4])[0]
+    pos += 4
+    comments = []
+    for i in range(count):
+        length = struct.unpack("<I", data[pos:pos + 4])[0]
+        comments.append(data[pos + 4:pos + 4 + length])
+        pos += 4 + length
+    return vendor, comments
+
+
+def pack_flac_picture(picture):
+    """Return a FLAC picture block (as used in Vorbis comments as well)
+    holding the front cover picture"""
+    mime, data = picture
+    # no description, and the size and colour depth are left unknown
+    return struct.pack(">II", 3, len(mime)) + mime + \
+        struct.pack(">IIIIII", 0, 0, 0, 0, 0, len(data)) + data
+
+
+def unpack_flac_picture(data):
+    """Return the (picture type, mime type, data) in a FLAC picture block"""
+    ptype, length = struct.unpack(">II", data[:8])
+    mime = data[8:8 + length]
+    pos = 8 + length
+    length = struct.unpack(">I", data[pos:pos + 4])[0]
+    # skip the description, size and colour depth
+    pos += 4 + length + 16
+    length = struct.unpack(">I", data[pos:pos + 4])[0]
+    picture = data[pos + 4:pos + 4 + length]
+    return ptype, image_mime(picture) or mime, picture
+
+
+def flac_blocks(fh):
+    """Return (block type, offset, length) for each metadata block of the
+    FLAC file fh, and the offset of the audio after them"""
+    fh.seek(0)
+    # skip any ID3v2 tag that's been put on the front
+    pos = id3_size(fh.read(10))
+    fh.seek(pos)
+    if fh.read(4) != 'fLaC':
+        raise ValueError("not a FLAC file")
+    pos += 4
+    blocks = []
+    while True:
+        header = fh.read(4)
+        if len(header) < 4:
+            raise ValueError("truncated FLAC metadata")
+        length = struct.unpack(">I", '\0' + header[1:])[0]
+        blocks.append((ord(header[0]) & 0x7f, pos + 4, length))
+        pos += 4 + length
+        if ord(header[0]) & 0x80:
+            return blocks, pos
+        fh.seek(pos)
+
+
+def write_flac_tags(fh, tags):
+    """Replace the comments and pictures of the FLAC file fh, using the
+    padding block flac was asked to write to make room"""
+    blocks, audio = flac_blocks(fh)
+    if blocks[0][0] != 0 or len(blocks) < 2:
+        return False
+    start = blocks[0][1] + blocks[0][2]
+    vendor = "amaKode"
+    comments = []
+    new = []
+    for btype, offset, length in blocks[1:]:
+        fh.seek(offset)
+        if btype == 4:
+            vendor, comments = unpack_vorbis_comment(fh.read(length))
+        elif btype not in (1, 6):
+            # seek tables and so on are kept
+            new.append((btype, fh.read(length)))
+    new.append((4, pack_vorbis_comment(vendor,
+        replace_comments(comments, tags))))
+    if 'picture' in tags:
+        new.append((6, pack_flac_picture(tags['picture'])))
+    room = audio - start
+    used = 0
+    for btype, body in new:
+        used += 4 + len(body)
+    if used < room:
+        if used + 4 > room:
+            # not even enough for an empty padding block
+            return False
+        new.append((1, '\0' * (room - used - 4)))
+    elif used > room:
+        return False
+    data = []
+    for i in range(len(new)):
+        btype, body = new[i]
+        if i == len(new) - 1:
+            btype |= 0x80
+        data.append(chr(btype) + struct.pack(">I", len(body))[1:] + body)
+    fh.seek(start)
+    fh.write("".join(data))
+    return True
+
+
+ogg_crc_table = []
+def ogg_crc(data):
+    """Return the checksum of an Ogg page"""
+    if not ogg_crc_table:
+        for i in range(256):
+            r = i << 24
+            for j in range(8):
+                if r & 0x80000000:
+                    r = ((r << 1) ^ 0x04c11db7) & 0xffffffff
+                else:
+                    r = (r << 1) & 0xffffffff
+            ogg_crc_table.append(r)
+    crc = 0
+    table = ogg_crc_table
+    for c in data:
+        crc = ((crc << 8) & 0xffffffff) ^ table[(crc >> 24) ^ ord(c)]
+    return crc
+
+
+def ogg_vorbis_headers(fh):
+    """Return the three Vorbis header packets at the start of the Ogg file
+    fh, and (offset, page header, body) for the pages after the first,
+    which hold the comment and setup headers and nothing else"""
+    packets = []
+    packet = ""
+    pages = []
+    pos = 0
+    while len(packets) < 3:
+        fh.seek(pos)
+        header = fh.read(27)
+        if len(header) < 27 or header[:4] != 'OggS':
+            raise ValueError("not an Ogg Vorbis file")
+        header += fh.read(ord(header[26]))
+        body = fh.read(sum([ord(c) for c in header[27:]]))
+        if pos:
+            pages.append((pos, header, body))
+        start = 0
+        for c in header[27:]:
+            packet += body[start:start + ord(c)]
+            start += ord(c)
+            if ord(c) < 255:
+                packets.append(packet)
+                packet = ""
+        if not pos and len(packets) != 1:
+            raise ValueError("the first Ogg page has more than one packet")
+        pos += len(header) + len(body)
+    if len(packets) > 3 or packet or packets[0][:7] != '\x01vorbis' or \
+            packets[1][:7] != '\x03vorbis':
+        raise ValueError("not an Ogg Vorbis file")
+    return packets, pages
+
+
+def write_ogg_tags(fh, tags):
+    """Replace the comment header of the Ogg Vorbis file fh in place. oggenc
+    was given padding comments to make room, and the new header is padded
+    out to the same length after its framing bit (which decoders ignore) so
+    the pages keep their layout."""
+    packets, pages = ogg_vorbis_headers(fh)
+    old = packets[1]
+    vendor, comments = unpack_vorbis_comment(old[7:])
+    new = '\x03vorbis' + pack_vorbis_comment(vendor,
+        replace_comments(comments, tags, with_picture=True)) + '\x01'
+    if len(new) > len(old):
+        return False
+    data = new + '\0' * (len(old) - len(new)) + packets[2]
+    for offset, header, body in pages:
+        body, data = data[:len(body)], data[len(body):]
+        header = header[:22] + '\0\0\0\0' + header[26:]
+        header = header[:22] + struct.pack("<I", ogg_crc(header + body)) + \
+            header[26:]
+        fh.seek(offset)
+        fh.write(header + body)
+    return True
+
+
+def mp4_atom(name, payload):
+    return struct.pack(">I", 8 + len(payload)) + name + payload
+
+
+def mp4_item(name, datatype, value):
+    """Return an ilst item holding value, of the given data type"""
+    return mp4_atom(name, mp4_atom('data', struct.pack(">II", datatype, 0) +
+        value))
+
+
+def mp4_ilst(tags):
+    """Return an ilst atom holding tags"""
+    items = []
+    for field, atom in zip(mp4wrap.textfields, mp4wrap.textatoms):
+        if field in tags:
+            items.append(mp4_item(atom, 1,
+                tag_text(tags[field]).encode('utf8')))
+    if 'year' in tags:
+        items.append(mp4_item('\xa9day', 1, str(tags['year'])))
+    if 'track' in tags:
+        items.append(mp4_item('trkn', 0,
+            struct.pack(">HHHH", 0, tags['track'], 0, 0)))
+    if 'picture' in tags:
+        mime, data = tags['picture']
+        items.append(mp4_item('covr', mime == 'image/png' and 14 or 13, data))
+    return mp4_atom('ilst', "".join(items))
+
+
+def mp4_pictures(fh):
+    """Return (picture type, mime type, data) for the cover art of the mp4
+    file fh"""
+    fh.seek(0, 2)
+    ilst = find_atom(fh, 0, fh.tell(), ['moov', 'udta', 'meta', 'ilst'])
+    if ilst is None:
+        return []
+    pictures = []
+    for name, start, end in mp4_atoms(fh, ilst[0], ilst[1]):
+        if name != 'covr':
+            continue
+        for dname, dstart, dend in mp4_atoms(fh, start, end):
+            if dname == 'data' and dend - dstart > 8:
+                fh.seek(dstart + 8)
+                data = fh.read(dend - dstart - 8)
+                pictures.append((3, image_mime(data), data))
+    return pictures
+
+
+def mp4_children(fh, start, end):
+    """Return (type, the whole atom) for each atom between start and end of
+    the mp4 file fh"""
+    children = []
+    pos = start
+    for name, payload, atomend in mp4_atoms(fh, start, end):
+        fh.seek(pos)
+        children.append((name, fh.read(atomend - pos)))
+        pos = atomend
+    return children
+
+
+def write_mp4_tags(fh, tags):
+    """Replace the moov/udta/meta atom of the mp4 file fh. faac writes the
+    moov atom after the audio, so it can simply grow; if it comes first it
+    has to fit in its old size plus any free atom after it."""
+    fh.seek(0, 2)
+    size = fh.tell()
+    pos = 0
+    top = mp4_atoms(fh, 0, size)
+    for i in range(len(top)):
+        name, payload, end = top[i]
+        if name == 'moov':
+            break
+        pos = end
+    else:
+        raise ValueError("no moov atom")
+    meta = mp4_atom('meta', '\0\0\0\0' +
+        mp4_atom('hdlr', '\0' * 8 + 'mdirappl' + '\0' * 9) + mp4_ilst(tags))
+    children = []
+    udta = False
+    child = payload
+    for name, childpayload, childend in mp4_atoms(fh, payload, end):
+        if name == 'udta':
+            # keep anything else in udta, but replace meta
+            udta = True
+            kept = [atom for grandchild, atom in
+                mp4_children(fh, childpayload, childend)
+                if grandchild != 'meta']
+            children.append(mp4_atom('udta', "".join(kept) + meta))
+        else:
+            fh.seek(child)
+            children.append(fh.read(childend - child))
+        child = childend
+    if not udta:
+        children.append(mp4_atom('udta', meta))
+    moov = mp4_atom('moov', "".join(children))
+    room = end - pos
+    following = top[i + 1:]
+    if following and following[0][0] in ('free', 'skip'):
+        room = following[0][2] - pos
+        following = following[1:]
+    if following:
+        if len(moov) != room and len(moov) + 8 > room:
+            return False
+        if len(moov) < room:
+            moov += mp4_atom('free', '\0' * (room - len(moov) - 8))
+    fh.seek(pos)
+    fh.write(moov)
+    if not following:
+        fh.truncate(pos + len(moov))
+    return True
+
+
+# Functions which write tags into each format of encoded file
+tag_writers = {
+    "mp3": write_id3_tags,
+    "ogg": write_ogg_tags,
+    "flac": write_flac_tags,
+    "mp4": write_mp4_tags,
+    "m4a": write_mp4_tags,
+}
+
+class atomicparsleywrap(dict):
+    textfields = ['album', 'artist', 'title', 'comment', 'genre']
+    apfields = ['alb', 'art', 'nam', 'cmt', 'gnre']
+    numfields = ['year', 'track']
+    allfields = textfields + numfields
+
+    def __init__(self, filename):
+        ap = subprocess.Popen([tools.find('AtomicParsley'), filename, '-t'],
+            stdout=subprocess.PIPE)
+        for line in ap.stdout:
+            fields = line.rstrip().split(None, 3)
+            if len(fields) == 4  and fields[0] == "Atom":
+                for apfield, textfield in zip(self.apfields, self.textfields):
+                    if fields[1].lower().find(apfield) != -1:
+                        self[textfield] = unicode(fields[3], 'utf8')
+                        break
+                else:
+                    if fields[1].lower().find('day') != -1:
+                        try:
+                            self['year'] = int(fields[3])
+                        except ValueError:
+                            self['year'] = 0
+                    elif fields[1].lower().find('trkn') != -1:
+                        try:
+                            self['track'] = int(fields[3].split()[0])
+                        except ValueError:
+                            self['track'] = 0
+        ap.wait()
+
+
+class tagpywrap(dict):
+    textfields = ['album', 'artist', 'title', 'comment', 'genre']
+    numfields = ['year', 'track']
+    allfields = textfields + numfields
+
+    def __init__(self, filename):
+        log.debug("Reading tags from " + filename)
+        self.tagInfo = tagpy.FileRef(filename).tag()
+
+        self['album'] = self.tagInfo.album.strip()
+        self['artist'] = self.tagInfo.artist.strip()
+        self['title'] = self.tagInfo.title.strip()
+        self['comment'] = self.tagInfo.comment.strip()
+        self['year'] = self.tagInfo.year
+        self['genre'] = self.tagInfo.genre.strip()
+        self['track'] = self.tagInfo.track
+        for i in self.textfields:
+            if self[i] == "":
+                del self[i]
+
+        for i in self.numfields:
+            if self[i] == 0:
+                del self[i]
+
+
+already_notified_missing_package = set()
+def notify_missing_package(name, ext, debian_package, rpm_package):
+    if name in already_notified_missing_package:
+        return
+    already_notified_missing_package.add(name)
+    if os.path.exists('/var/lib/apt'):
+        # smells like a debian system, so use the debian package name
+        package = debian_package
+    else:
+        package = rpm_package # rpm-based and gentoo seem to be mostly the same
+    tagpymsg = 'Amakode can not find the ' + name + ' library. '
+    tagpymsg += 'Please install the ' + package + ' package, '
+    tagpymsg += 'otherwise any ' + ext + ' files copied to your media player'
+    tagpymsg += 'will not have tags.'
+    notifier.popup(tagpymsg)
+
+
+class storedtags(dict):
+    """Tags read from the LibraryIndex"""
+    textfields = tagpywrap.textfields
+    numfields = tagpywrap.numfields
+    allfields = textfields + numfields
+
+
+class QueueMgr(object):
+    """Runs jobs, up to maxjobs at a time.
+
+    Queued jobs are kept in a heap and the most expensive (by
+    TranscodeJob.cost()) is started first, so a long job doesn't end up
+    running on its own after everything else has finished.
+    """
+    # LoadController which changes maxjobs as we go, or None for a fixed
+    # number of jobs
+    controller = None
+
+    # JobStats recording every finished job, or None
+    stats = None
+
+    # JobJournal recording the queue so it can be resumed, or None
+    journal = None
+
+    # How many jobs to take from add_lazily() iterators before choosing the
+    # most expensive. More gets closer to the best order, but reads further
+    # ahead of the jobs actually running.
+    lookahead = 256
+
+    def __init__(self, callback=None, maxjobs=None):
+        self.callback = callback
+        # heap of (-cost, order added, job)
+        self.queuedjobs = []
+        self.activejobs = []
+        # queued and active jobs by key(), to spot duplicates
+        self.jobs_by_key = {}
+        # iterators of jobs which are only consumed when a slot is free
+        self.feeds = []
+        # breaks ties between jobs of the same cost in the order they came
+        self.added = 0
+
+        if maxjobs:
+            self.maxjobs = maxjobs
+            log.debug('Using %d concurrent jobs', self.maxjobs)
+        else:
+            self.maxjobs = number_of_processors()
+            log.debug('Using %d concurrent jobs because it seems there are '
+                '%d processors', self.maxjobs, self.maxjobs)
+        if self.controller is not None:
+            self.maxjobs = self.controller.clamp(self.maxjobs)
+            log.debug('Starting with %d concurrent jobs', self.maxjobs)
+
+        if self.journal is not None and not self.journal.open():
+            log.debug("%s is in use, not keeping a journal" %
+                self.journal.filename)
+            self.journal = None
+
+        # Self-pipe written to by the SIGCHLD handler, so that wait() can
+        # wake up as soon as a child exits
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in self.wakeup_r, self.wakeup_w:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        signal.signal(signal.SIGCHLD, self.onChild)
+        if hasattr(signal, 'siginterrupt'):
+            # don't interrupt blocking reads and waitpid calls elsewhere
+            signal.siginterrupt(signal.SIGCHLD, False)
+
+    def onChild(self, signum, stackframe):
+        self.wake()
+
+    def wake(self):
+        """Make wait() return, e.g. when a job finishes in a thread"""
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError:
+            # pipe is full, so there's already a wakeup pending
+            pass
+
+    def add(self, job):
+        """Queue job. If an identical job is already queued or running,
+        job is finished along with it instead and False is returned."""
+        twin = self.jobs_by_key.get(job.key())
+        if twin is not None:
+            log.debug("%s is already queued, waiting for that" % job)
+            twin.duplicates.append(job)
+            return False
+        self.jobs_by_key[job.key()] = job
+        cost = job.cost()
+        log.debug("Job added, cost %.1f" % cost)
+        if self.journal is not None and job.journal_id is None:
+            self.journal.add(job)
+        heapq.heappush(self.queuedjobs, (-cost, self.added, job))
+        self.added += 1
+        return True
+
+    def add_lazily(self, jobs):
+        """Queue every job from the iterable jobs, taking them one at a time
+        as slots become free"""
+        self.feeds.append(iter(jobs))
+
+    def next_job(self):
+        while self.feeds and len(self.queuedjobs) < self.lookahead:
+            try:
+                self.add(self.feeds[0].next())
+            except StopIteration:
+                self.feeds.pop(0)
+        if self.queuedjobs:
+            return heapq.heappop(self.queuedjobs)[2]
+        return None
+
+    def poll(self):
+        """Reap finished jobs and start new ones until nothing changes"""
+
+        if self.controller is not None:
+            self.maxjobs = self.controller.adjust(self.maxjobs,
+                len(self.activejobs),
+                len(self.queuedjobs) > 0 or len(self.feeds) > 0)
+
+        while True:
+            while self.used_slots() < self.maxjobs:
+                newjob = self.next_job()
+                if newjob is None:
+                    break
+                newjob.queue = self
+                newjob.start()
+                if self.journal is not None:
+                    self.journal.started(newjob)
+                self.activejobs.append(newjob)
+
+            # jobs which fail to start or are served from the cache finish
+            # without a child exiting, so go round again until none finish
+            finished = [j for j in self.activejobs if j.isfinished()]
+            if not finished:
+                break
+            for j in finished:
+                log.debug("job is done")
+                self.activejobs.remove(j)
+                del self.jobs_by_key[j.key()]
+                if self.stats is not None:
+                    self.stats.record(j)
+                if self.callback:
+                    self.callback(j)
+                    for duplicate in j.duplicates:
+                        duplicate.share_result(j)
+                        self.callback(duplicate)
+                if self.journal is not None:
+                    self.journal.finished(j.journal_id, not j.errormsg)
+
+        if self.journal is not None and self.isidle():
+            self.journal.clear()
+
+    def used_slots(self):
+        """Return how many of the maxjobs the active jobs are using"""
+        used = 0
+        for job in self.activejobs:
+            used += job.slots()
+        return used
+
+    def wait(self, fds=(), timeout=None):
+        """Block until a child exits, one of fds is readable or timeout
+        expires. Returns the list of readable fds."""
+
+        if timeout is None and self.controller is not None and \
+                not self.isidle():
+            # wake up regularly to look at the load again
+            timeout = self.controller.interval
+        try:
+            ready = select.select([self.wakeup_r] + list(fds), [], [],
+                timeout)[0]
+        except select.error, e:
+            if e[0] != errno.EINTR:
+                raise
+            return []
+        if self.wakeup_r in ready:
+            ready.remove(self.wakeup_r)
+            try:
+                while os.read(self.wakeup_r, 4096):
+                    pass
+            except OSError:
+                pass
+        return ready
+
+    def isidle(self):
+        """Returns true if both queues are empty"""
+        return len(self.queuedjobs) == 0 and len(self.activejobs) == 0 and \
+            len(self.feeds) == 0
+
+
+class JobStats(object):
+    """Performance records of finished jobs.
+
+    Each job's stats() are written as a line of JSON to filename, if given,
+    and added to running totals which the "stats" command reports.
+    """
+
+    stages = ['queue_wait', 'download', 'tags', 'copy', 'decoder_stall',
+        'encoder_stall', 'tag_write', 'total']
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.totals = {"jobs": 0, "failed": 0, "cached": 0, "bytes_in": 0,
+            "bytes_out": 0, "cpu_seconds": 0.0}
+        for stage in self.stages + ['decoder', 'encoder']:
+            self.totals[stage + "_seconds"] = 0.0
+
+    def record(self, job):
+        record = job.stats()
+        if self.filename and json:
+            try:
+                fh = open(self.filename, 'a')
+                try:
+                    fh.write(json.dumps(record) + "\n")
+                finally:
+                    fh.close()
+            except IOError:
+                log.exception("Unable to write stats to " + self.filename)
+
+        totals = self.totals
+        for stage in self.stages:
+            totals[stage + "_seconds"] += record.get(stage, 0)
+        totals["bytes_in"] += record.get("bytes_in") or 0
+        outputs = record.get("outputs", [record])
+        for r in [record] + record.get("outputs", []):
+            for name in ("decoder", "encoder"):
+                if name in r:
+                    totals[name + "_seconds"] += r[name]["wall"]
+                    totals["cpu_seconds"] += r[name].get("user", 0) + \
+                        r[name].get("system", 0)
+        for output in outputs:
+            totals["jobs"] += 1
+            if not output["ok"]:
+                totals["failed"] += 1
+            if output["cached"]:
+                totals["cached"] += 1
+            totals["bytes_out"] += output["bytes_out"] or 0
+
+    def report(self):
+        """Return the totals as a line of JSON"""
+        if not json:
+            return repr(self.totals)
+        return json.dumps(self.totals)
+
+
+class LoadController(object):
+    """Decides how many jobs to run from how busy the machine is.
+
+    Every interval seconds the CPU, I/O wait and memory figures in /proc are
+    sampled. Another job is allowed while CPUs are idle or waiting for I/O,
+    and one is taken away when the CPUs are saturated, the load is high or
+    memory is running out, always staying between minjobs and maxjobs.
+    """
+
+    interval = 2.0
+
+    def __init__(self, minjobs, maxjobs, min_free_memory=128 * 1024 * 1024):
+        self.minjobs = minjobs
+        self.maxjobs = maxjobs
+        self.min_free_memory = min_free_memory
+        self.cpus = number_of_processors()
+        self.last_time = 0
+        self.last_sample = None
+
+    def clamp(self, jobs):
+        """Return jobs, kept between minjobs and maxjobs"""
+        return max(self.minjobs, min(self.maxjobs, jobs))
+
+    def adjust(self, maxjobs, active, waiting):
+        """Return the new number of jobs to allow"""
+        # the bounds apply from the start, not just after two samples
+        maxjobs = self.clamp(maxjobs)
+        now = time.time()
+        if now < self.last_time + self.interval:
+            return maxjobs
+        self.last_time = now
+        try:
+            sample = cpu_times()
+            free = available_memory()
+            load = os.getloadavg()[0]
+        except (IOError, OSError, ValueError):
+            log.exception("Unable to measure the load")
+            return maxjobs
+        last, self.last_sample = self.last_sample, sample
+        if last is None:
+            return maxjobs
+
+        total = sample[0] - last[0]
+        if total <= 0:
+            return maxjobs
+        idle = (sample[1] - last[1]) / total
+        iowait = (sample[2] - last[2]) / total
+        busy = 1 - idle - iowait
+        log.debug("cpu %.0f%%, iowait %.0f%%, load %.1f, %dMiB free, "
+            "about %.2f cpus per job" % (busy * 100, iowait * 100, load,
+            free / 1024 / 1024, busy * self.cpus / max(active, 1)))
+
+        jobs = maxjobs
+        if free < self.min_free_memory:
+            jobs -= 1
+        elif busy > 0.95 or load > self.cpus * 2:
+            jobs -= 1
+        elif waiting and active >= maxjobs and (busy < 0.8 or iowait > 0.1):
+            jobs += 1
+        jobs = self.clamp(jobs)
+        if jobs != maxjobs:
+            log.debug("now running up to %d jobs" % jobs)
+        return jobs
+
+
+class ChildLimits(object):
+    """Priority and resource limits for the programs run by each job.
+
+    nice is added to the niceness of each program, ioclass is an ionice
+    class (2 for best-effort at the lowest priority, 3 for idle) and cgroup
+    is a cgroup directory to put each program in.
+    """
+
+    def __init__(self, nice=0, ioclass=None, cgroup=None):
+        self.nice = nice
+        self.ioclass = ioclass
+        self.cgroup = cgroup
+
+    def command(self, command):
+        """Return command wrapped in ionice if required"""
+        if self.ioclass is None:
+            return command
+        ionice = tools.find('ionice')
+        if not ionice:
+            log.debug("ionice not found, ignoring --ionice")
+            return command
+        prefix = [ionice, "-c", str(self.ioclass)]
+        if self.ioclass == 2:
+            prefix += ["-n", "7"]
+        return prefix + command
+
+    def preexec(self):
+        # runs in the child between fork and exec
+        if self.nice:
+            os.nice(self.nice)
+        if self.cgroup:
+            procs = open(os.path.join(self.cgroup, 'cgroup.procs'), 'a')
+            try:
+                procs.write(str(os.getpid()))
+            finally:
+                procs.close()
+
+
+class TranscodeCache(object):
+    """A persistent on-disk cache of finished transcodes.
+
+    Entries are keyed on the identity of the source, the target format and
+    the encoder command line. Entries are published with an atomic rename so
+    a crash never leaves a half-written file in the cache, and the least
+    recently used entries are discarded once the cache grows past maxbytes.
+    Entries are copies rather than hard links, so that editing an output's
+    tags later can't change what the cache hands out.
+    """
+
+    def __init__(self, directory, maxbytes, hash_contents=False):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.hash_contents = hash_contents
+        # path -> (mtime, size), loaded on first use
+        self._entries = None
+        self._total = 0
+
+    def key(self, infname, tofmt, encoder, hash_contents=False,
+            identity=None):
+        """Return the cache key for transcoding infname with encoder.
+
+        If identity is given it identifies the source instead of infname.
+        """
+        digest = sha1()
+        if identity is not None:
+            digest.update(identity)
+        elif hash_contents or self.hash_contents:
+            fh = open(infname, 'rb')
+            try:
+                while True:
+                    chunk = fh.read(1024 * 64)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+            finally:
+                fh.close()
+        else:
+            st = os.stat(infname)
+            digest.update("%d:%d:%d:%d" % (st.st_dev, st.st_ino,
+                st.st_size, int(st.st_mtime)))
+        digest.update("\0".join([tofmt] + encoder))
+        return digest.hexdigest()
+
+    def path(self, key, tofmt):
+        return os.path.join(self.directory, key[:2], key + "." + tofmt)
+
+    def fetch(self, key, tofmt, outfd):
+        """Copy the entry for key to outfd. Returns True on a hit."""
+        path = self.path(key, tofmt)
+        try:
+            fh = open(path, 'rb')
+        except IOError:
+            return False
+        try:
+            copy_to_fd(fh, outfd)
+        finally:
+            fh.close()
+        # bump the mtime so that eviction sees this entry as recently used
+        os.utime(path, None)
+        self._load()
+        self._add(path)
+        log.debug("cache hit for " + path)
+        return True
+
+    def store(self, key, tofmt, filename):
+        """Atomically add filename to the cache as key. It's only a cache,
+        so it isn't worth an fsync."""
+        path = self.path(key, tofmt)
+
+        def write(fd):
+            fh = open(filename, 'rb')
+            try:
+                copy_to_fd(fh, fd)
+            finally:
+                fh.close()
+        write_atomically(path, write)
+        log.debug("cached " + filename + " as " + path)
+        self._load()
+        self._add(path)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until we are under maxbytes"""
+        self._load()
+        if self._total <= self.maxbytes:
+            return
+        entries = [(mtime, path) for path, (mtime, size)
+            in self._entries.items()]
+        entries.sort()
+        for mtime, path in entries:
+            if self._total <= self.maxbytes:
+                break
+            log.debug("evicting " + path + " from the cache")
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            self._total -= self._entries.pop(path)[1]
+
+    def _add(self, path):
+        st = os.stat(path)
+        old = self._entries.get(path)
+        if old is not None:
+            self._total -= old[1]
+        self._entries[path] = (st.st_mtime, st.st_size)
+        self._total += st.st_size
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        self._total = 0
+        if not os.path.isdir(self.directory):
+            return
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.startswith('.'):
+                    continue
+                try:
+                    self._add(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+
+
+class JobJournal(object):
+    """An append-only log of the jobs given to a QueueMgr, so that a crash
+    or restart doesn't lose them.
+
+    Each line is a record of fields from join_fields():
+
+        add <id> <time> <source url> <format> <destination> [<format> ...]
+        files <id> <temporary file>...
+        done <id> ok|failed
+        output <destination>
+
+    where an empty destination means a temporary file. Lines are flushed as
+    they are written. When the journal is opened the jobs which were never
+    done are remembered to be resumed and their temporary files are deleted.
+    It is emptied whenever the queue is idle, except for the jobs which the
+    process didn't resume (see resume_jobs). A lock file stops two
+    processes using the same journal.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fh = None
+        self.lockfh = None
+        # whether anything has been written since the journal was tidied
+        self.dirty = False
+        # id -> [time, url, [(format, destination)], [temporary file]] of
+        # the jobs not done yet
+        self.entries = {}
+        # destinations of the outputs finished successfully
+        self.outputs = set()
+        self.next_id = 0
+
+    def open(self):
+        """Lock and load the journal. Returns False if another process is
+        using it. The file is only tidied up when something is first written
+        to it, so an idle Amarok script never touches it."""
+        if self.lockfh is not None:
+            return True
+        lockfh = open(self.filename + ".lock", 'a')
+        try:
+            fcntl.flock(lockfh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lockfh.close()
+            return False
+        self.lockfh = lockfh
+        self.load()
+        self.sweep()
+        return True
+
+    def load(self):
+        try:
+            fh = open(self.filename, 'rb')
+        except IOError:
+            return
+        try:
+            for line in fh:
+                if not line.endswith("\n"):
+                    # cut short by a crash
+                    break
+                try:
+                    self.replay(split_fields(line))
+                except (ValueError, IndexError, KeyError):
+                    log.debug("ignoring bad journal line %r" % line)
+        finally:
+            fh.close()
+
+    def replay(self, fields):
+        if fields[0] == "add":
+            outputs = zip(fields[4::2], fields[5::2])
+            self.entries[fields[1]] = [float(fields[2]), fields[3], outputs,
+                []]
+            self.next_id = max(self.next_id, int(fields[1]) + 1)
+        elif fields[0] == "files":
+            self.entries[fields[1]][3].extend(fields[2:])
+        elif fields[0] == "done":
+            entry = self.entries.pop(fields[1])
+            if fields[2] == "ok":
+                for tofmt, dest in entry[2]:
+                    if dest:
+                        self.outputs.add(dest)
+        elif fields[0] == "output":
+            self.outputs.add(fields[1])
+
+    def sweep(self):
+        """Delete the temporary files of jobs which never finished"""
+        for entry in self.entries.values():
+            for filename in entry[3]:
+                if os.path.exists(filename):
+                    log.debug("removing orphaned " + filename)
+                    try:
+                        os.unlink(filename)
+                    except OSError:
+                        pass
+            entry[3] = []
+
+    def rewrite(self):
+        """Replace the journal with just what we still need from it"""
+        lines = []
+        for dest in self.outputs:
+            lines.append(join_fields(["output", dest]))
+        for jid, (added, url, outputs, files) in self.entries.items():
+            fields = ["add", jid, repr(added), url]
+            for tofmt, dest in outputs:
+                fields += [tofmt, dest]
+            lines.append(join_fields(fields))
+        if self.fh is not None:
+            self.fh.close()
+        write_atomically(self.filename,
+            lambda fd: os.write(fd, "".join(lines)))
+        self.fh = open(self.filename, 'ab')
+        self.dirty = bool(lines)
+
+    def write(self, *fields):
+        if self.fh is None:
+            self.rewrite()
+        self.fh.write(join_fields(fields))
+        self.fh.flush()
+        self.dirty = True
+        self.replay(list(fields))
+
+    def pending(self):
+        """Return (id, time added, url, [(format, destination)]) for each
+        job which wasn't done, oldest first"""
+        jobs = [(int(jid), jid, entry) for jid, entry in self.entries.items()]
+        jobs.sort()
+        return [(jid, entry[0], entry[1], entry[2])
+            for n, jid, entry in jobs]
+
+    def finished_outputs(self):
+        """Return the destinations of the outputs already finished"""
+        return set(self.outputs)
+
+    def add(self, job):
+        job.journal_id = str(self.next_id)
+        self.next_id += 1
+        if isinstance(job, FanoutJob):
+            outputs = job.jobs
+        else:
+            outputs = [job]
+        fields = ["add", job.journal_id, repr(time.time()), job.inurl]
+        for output in outputs:
+            fields += [output.tofmt, output.dest or ""]
+        self.write(*fields)
+
+    def started(self, job):
+        files = job.temp_files()
+        if files:
+            self.write("files", job.journal_id, *files)
+
+    def finished(self, jid, ok):
+        if ok:
+            self.write("done", jid, "ok")
+        else:
+            self.write("done", jid, "failed")
+
+    def clear(self):
+        """Forget the jobs which are done, once the queue is idle. Any left
+        are jobs this process didn't resume, so they are kept for one which
+        will."""
+        if not self.dirty:
+            return
+        self.outputs = set()
+        if self.entries:
+            self.rewrite()
+        else:
+            self.fh.close()
+            self.fh = open(self.filename, 'wb')
+        self.dirty = False
+
+
+class SyncManifest(object):
+    """Records what --sync has written into a destination directory.
+
+    For each source (relative to the source directory) the size and mtime
+    it had, the encoder settings and the outputs (relative to the
+    destination) are kept, marshalled into filename.
+    """
+
+    filename = ".amakode-sync"
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.changed = False
+        try:
+            fh = open(path, 'rb')
+        except IOError:
+            return
+        try:
+            try:
+                self.entries = marshal.load(fh)
+            except (EOFError, ValueError, TypeError):
+                log.debug("ignoring damaged manifest " + path)
+        finally:
+            fh.close()
+
+    def current(self, relname, st, settings, outputs):
+        """Returns true if the outputs of the source relname, whose
+        os.stat() is st, are up to date"""
+        dests = [os.path.join(os.path.dirname(self.path), output)
+            for output in outputs]
+        for dest in dests:
+            if not os.path.exists(dest):
+                return False
+        entry = self.entries.get(relname)
+        if entry is None:
+            # written before there was a manifest: adopt it if it's newer
+            for dest in dests:
+                if os.path.getmtime(dest) < st.st_mtime:
+                    return False
+            self.update(relname, st, settings, outputs)
+            return True
+        return entry[:3] == (st.st_size, st.st_mtime, settings)
+
+    def update(self, relname, st, settings, outputs):
+        """Record that outputs were written from the source relname"""
+        old = self.entries.get(relname)
+        if old is not None:
+            # outputs in formats no longer wanted
+            for output in old[3]:
+                if output not in outputs:
+                    try:
+                        os.unlink(os.path.join(os.path.dirname(self.path),
+                            output))
+                    except OSError:
+                        pass
+        self.entries[relname] = (st.st_size, st.st_mtime, settings,
+            list(outputs))
+        self.changed = True
+
+    def sources(self):
+        return self.entries.keys()
+
+    def remove(self, relname):
+        """Forget the source relname, returning its outputs"""
+        self.changed = True
+        return self.entries.pop(relname)[3]
+
+    def save(self):
+        if not self.changed:
+            return
+        data = marshal.dumps(self.entries)
+        write_atomically(self.path, lambda fd: os.write(fd, data), sync=True)
+        self.changed = False
+
+
+class LibraryIndex(object):
+    """A database of what we know about each source file.
+
+    Tags, length and the result of the last transcode to each format are
+    remembered against the path, size and mtime of the file, so unchanged
+    files can be handled with a stat rather than by reading them.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = None
+        self.writes = 0
+        self.last_commit = time.time()
+
+    def __nonzero__(self):
+        # the index is quietly left out if sqlite3 isn't available, but
+        # we don't look for it until the first job needs the index
+        return bool(sqlite3)
+
+    def connect(self):
+        if self.db is not None:
+            return self.db
+        log.debug("Opening index " + self.filename)
+        self.db = sqlite3.connect(self.filename)
+        # this is only a cache of what's in the files, so speed matters
+        # more than surviving a crash
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+            "format TEXT, tags BLOB, length REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS transcodes ("
+            "path TEXT, format TEXT, size INTEGER, mtime REAL, "
+            "error TEXT, elapsed REAL, PRIMARY KEY (path, format))")
+        atexit.register(self.flush)
+        return self.db
+
+    def lookup(self, filename):
+        """Return (path, size, mtime, row) for filename, where row is the
+        (tags, length) stored for the current version of the file"""
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        row = self.connect().execute("SELECT tags, length FROM files "
+            "WHERE path = ? AND size = ? AND mtime = ?",
+            (path, st.st_size, st.st_mtime)).fetchone()
+        return path, st.st_size, st.st_mtime, row
+
+    def tags(self, filename, ext):
+        """get_tags(filename, ext), from the index if possible"""
+        path, size, mtime, row = self.lookup(filename)
+        if row is not None and row[0] is not None:
+            return storedtags(marshal.loads(str(row[0])))
+        taginfo = get_tags(filename, ext)
+        if taginfo is not None:
+            # don't remember failures, the tools may be installed later
+            self.update(path, size, mtime, ext, tags=sqlite3.Binary(
+                marshal.dumps(dict(taginfo))))
+        return taginfo
+
+    def length(self, filename, ext):
+        """audio_length(filename, ext), from the index if possible"""
+        path, size, mtime, row = self.lookup(filename)
+        if row is not None and row[1] is not None:
+            return row[1]
+        length = audio_length(filename, ext)
+        if length is not None:
+            self.update(path, size, mtime, ext, length=length)
+        return length
+
+    def update(self, path, size, mtime, ext, **fields):
+        db = self.connect()
+        row = db.execute("SELECT tags, length FROM files "
+            "WHERE path = ? AND size = ? AND mtime = ?",
+            (path, size, mtime)).fetchone()
+        if row is None:
+            row = (None, None)
+        tags = fields.get('tags', row[0])
+        length = fields.get('length', row[1])
+        db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+            (path, size, mtime, ext, tags, length))
+        self.wrote()
+
+    def record_transcode(self, filename, tofmt, errormsg, elapsed):
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        self.connect().execute("INSERT OR REPLACE INTO transcodes "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (path, tofmt, st.st_size, st.st_mtime, errormsg, elapsed))
+        self.wrote()
+
+    def wrote(self):
+        # committing every row would make a big first scan crawl
+        self.writes += 1
+        if self.writes >= 100 or time.time() > self.last_commit + 5:
+            self.flush()
+
+    def flush(self):
+        if self.db is not None:
+            self.db.commit()
+        self.writes = 0
+        self.last_commit = time.time()
+
+
+class TranscodeJob(object):
+    # Programs used to decode (to a wav stream)
+    decode = {}
+    decode["mp3"] = ["mpg123", "-w", "/dev/stdout", "-"]
+    decode["ogg"] = ["ogg123", "-d", "wav", "-f", "-", "-"]
+    # XXX: this is really fugly but faad refuses to read from a pipe
+    decode["mp4"] = ["env", "MPLAYER_VERBOSE=-100", "mplayer", "-ao",
+        "pcm:file=/dev/stdout", "-"]
+    decode["m4a"] = decode["mp4"]
+    decode["flac"] = ["flac", "-d", "-c", "-"]
+    decode["wav"] = ["cat"]
+    decode["mpc"] = ["mpcdec", "-", "-"]
+
+    # Programs used to encode (from a wav stream)
+    encode = {}
+    encode["mp3"] = ["lame", "--abr", "128", "-", "-"]
+    encode["ogg"] = ["oggenc", "-"]
+    encode["mp4"] = ["faac", "-wo", "/dev/stdout", "-"]
+    encode["m4a"] = encode["mp4"]
+    encode["wav"] = ["cat"]
+    encode["mpc"] = ["mpcenc", "--silent", "--standard", "-", "-"]
+
+    # flac's wav parser chokes on the header mpg123 writes to a pipe, so its
+    # input goes through a RiffFilter (see normalise_wav)
+    encode["flac"] = ["flac", "--silent", "-c", "-"]
+
+    # Formats which are already a wav stream. They are read straight into
+    # the encoder or written straight from the decoder, without a process
+    # in between
+    passthrough = ["wav"]
+
+    # Encoders which need the wav header rewritten before they accept it
+    normalise_wav = ["flac"]
+
+    # Options for output programs to store tag information, for the formats
+    # write_tags can't handle
+    tagopt = {}
+    tagopt["mp3"] = {
+        "album": "--tl",
+        "artist": "--ta",
+        "title": "--tt",
+        "comment": "--tc",
+        "genre": "--tg",
+        "year": "--ty",
+        "track": "--tn"
+    }
+    tagopt["ogg"] = {
+        "album": "-l",
+        "artist": "-a",
+        "title": "-t",
+        "comment": "--comment=comment=%s",
+        "genre": "-G",
+        "year": "-d",
+        "track": "-N"
+    }
+    tagopt["mp4"] = {
+        "album": "--album",
+        "artist": "--artist",
+        "title": "--title",
+        "comment": "--comment",
+        "genre": "--genre",
+        "year": "--year",
+        "track": "--track"
+    }
+    tagopt["m4a"] = tagopt["mp4"]
+    tagopt["flac"] = {
+        "album": "-Talbum=%s",
+        "artist": "-Tartist=%s",
+        "title": "-Ttitle=%s",
+        "comment": "-Tcomment=%s",
+        "genre": "-Tgenre=%s",
+        "year": "-Tdate=%s",
+        "track": "-Ttracknumber=%s"
+    }
+    tagopt["mpc"] = {
+        "album": "--album",
+        "artist": "--artist",
+        "title": "--title",
+        "comment": "--comment",
+        "genre": "--genre",
+        "year": "--year",
+        "track": "--track"
+    }
+
+    # Options asking the encoders of the formats in tag_writers to leave
+    # room for the tags, which write_tags fills in once they have finished.
+    # %d is the room needed in bytes. oggenc can't pad, so it's given
+    # throwaway comments instead, and faac writes its moov atom after the
+    # audio, where it can grow.
+    tagspace = {}
+    tagspace["mp3"] = ["--pad-id3v2-size", "%d"]
+    tagspace["flac"] = ["--padding=%d"]
+
+    # Room to leave on top of the tags, for anything the encoder adds
+    tag_slack = 1024
+
+    # TranscodeCache shared by all jobs, or None to always transcode
+    cache = None
+
+    # LibraryIndex shared by all jobs, or None to always read the source
+    index = None
+
+    # ChildLimits applied to every decoder and encoder, or None
+    limits = None
+
+    # Decoders which need to seek in their input, so remote sources have to
+    # be downloaded completely before they can start
+    seekable_decode = ["mp4", "m4a"]
+
+    # Typical size of a second of audio in each format, to estimate the size
+    # of the output
+    bytes_per_second = {
+        "wav": 176400,
+        "flac": 88000,
+        "mp3": 16000,
+        "ogg": 14000,
+        "mp4": 16000,
+        "m4a": 16000,
+        "mpc": 22000,
+    }
+
+    # Relative CPU cost of decoding and encoding a second of audio in each
+    # format, used to decide which jobs to start first
+    decode_cost = {
+        "mp3": 1.0,
+        "ogg": 1.0,
+        "mp4": 3.0,
+        "m4a": 3.0,
+        "flac": 0.5,
+        "wav": 0.1,
+        "mpc": 1.0,
+    }
+    encode_cost = {
+        "mp3": 4.0,
+        "ogg": 4.0,
+        "mp4": 4.0,
+        "m4a": 4.0,
+        "wav": 0.1,
+        "mpc": 2.0,
+    }
+    # Costs of particular decoder/encoder pairs, replacing the sum of
+    # decode_cost and encode_cost
+    pair_cost = {
+        ("wav", "wav"): 0.05,
+    }
+
+    # The codec used by each format. Sources already in the codec of the
+    # target format are copied rather than transcoded.
+    codec = {
+        "mp3": "mp3",
+        "ogg": "vorbis",
+        "mp4": "aac",
+        "m4a": "aac",
+        "flac": "flac",
+        "wav": "pcm",
+        "mpc": "musepack",
+    }
+
+    # Whether to copy sources already in the target codec, and the highest
+    # bitrate (in kbit/s) to copy, or None for the bitrate the encoder aims
+    # for (see encode_bitrate)
+    copy_same_codec = True
+    max_copy_bitrate = None
+
+    # Roughly the bitrate (in kbit/s) of each lossy encoder's output. Lossless
+    # formats aren't listed, copying them is always as good as transcoding.
+    encode_bitrate = {
+        "mp3": 128,
+        "ogg": 112,
+        "mp4": 128,
+        "m4a": 128,
+        "mpc": 170,
+    }
+
+    # Length of audio to assume when we can't tell the size of the source
+    default_length = 240
+
+    # How much of a streamed source to read before starting the decoder. The
+    # tags are read from this much of the file.
+    stream_head = 1024 * 256
+
+    # Size to make the pipes to and from each process, or 0 to leave them
+    pipe_size = 0
+
+    # Most to buffer between the decoder and encoder in a PipeBuffer, or 0 to
+    # connect them directly
+    pipe_buffer = 0
+
+    def __init__(self, _inurl, _tofmt):
+        self.errormsg = None
+        self.cachekey = None
+        self.cached = False
+        self.streaming = False
+        self.remote_identity = None
+        self.input_error = None
+        # the job which reads the input, for FanoutJob's children
+        self.input_job = self
+        # directory to write the output in, or None for the temp directory
+        self.outdir = None
+        # where the output will be published, if we know
+        self.dest = None
+        # the tags of the source, once read, for write_tags
+        self.taginfo = None
+        # the job's id in QueueMgr.journal
+        self.journal_id = None
+        # identical jobs given to the QueueMgr while this one was queued
+        self.duplicates = []
+        self.insize = None
+        self.endtime = None
+        self.bytes_out = None
+        self.copying = False
+        self.copied = False
+        # the QueueMgr running this job
+        self.queue = None
+        # seconds spent in each stage of the job, and the resource usage of
+        # each child process, for stats()
+        self.queuedtime = time.time()
+        self.timings = {}
+        self.usage = {}
+        log.debug("Creating job")
+        self.inurl = _inurl
+        self.tofmt = _tofmt.lower()
+        self.inext = os.path.splitext(self.inurl)[1].lstrip('.').lower()
+        self._files_to_clean_up_on_success = []
+        self._files_to_clean_up_on_error = []
+
+    def start(self):
+        log.debug("Starting job")
+        self.starttime = time.time()
+        self.timings['queue_wait'] = self.starttime - self.queuedtime
+        try:
+            if self.same_codec():
+                self.prepare_files()
+                if self.bitrate_ok():
+                    self.start_copy()
+                    return
+                self.check_codecs()
+            else:
+                self.check_codecs()
+                self.prepare_files()
+            if not self.fetch_from_cache():
+                self.start_codec()
+        except Exception:
+            log.exception("Failed to start")
+            self.errormsg = str(sys.exc_info()[1])
+
+    def cost(self):
+        """Estimate how much CPU time this job will take, in arbitrary
+        units"""
+        return self.source_length() * self.weight(self.tofmt)
+
+    def weight(self, tofmt):
+        try:
+            return self.pair_cost[(self.inext, tofmt)]
+        except KeyError:
+            return self.decode_cost.get(self.inext, 1.0) + \
+                self.encode_cost.get(tofmt, 1.0)
+
+    def source_length(self):
+        """Estimate the length of the source in seconds, just from its
+        size"""
+        scheme, netloc, path = urlparse.urlsplit(self.inurl)[:3]
+        if scheme == 'file':
+            try:
+                size = os.path.getsize(urllib.url2pathname(path))
+                return float(size) / self.bytes_per_second[self.inext]
+            except (OSError, KeyError):
+                pass
+        return self.default_length
+
+    def same_codec(self):
+        """Returns true if the source can be copied instead of transcoded"""
+        return self.copy_same_codec and self.inext in self.codec and \
+            self.codec.get(self.inext) == self.codec.get(self.tofmt)
+
+    def bitrate_ok(self):
+        """Returns true if the source's bitrate is low enough to copy it"""
+        limit = self.max_copy_bitrate
+        if limit is None:
+            limit = self.encode_bitrate.get(self.tofmt)
+        if limit is None:
+            return True
+        if self.streaming or not tagpy:
+            # we can't tell, so be safe and transcode
+            return False
+        try:
+            bitrate = tagpy.FileRef(self.infname).audioProperties().bitrate
+        except Exception:
+            log.debug("unable to find the bitrate of " + self.infname)
+            return False
+        return 0 < bitrate <= limit
+
+    def start_copy(self):
+        """Copy the source to the output in a thread"""
+        log.debug("copying " + self.inurl + ", it is already " +
+            self.codec[self.tofmt])
+        self.copying = True
+        copier = threading.Thread(target=self.copy_input)
+        copier.setDaemon(True)
+        copier.start()
+
+    def copy_input(self):
+        start = time.time()
+        try:
+            try:
+                if self.streaming:
+                    copy_to_fd(StringIO(self.head), self.outfd)
+                    copy_to_fd(self.source, self.outfd)
+                else:
+                    fh = open(self.infname, 'rb')
+                    try:
+                        copy_to_fd(fh, self.outfd)
+                    finally:
+                        fh.close()
+            except (IOError, OSError):
+                self.input_error = str(sys.exc_info()[1])
+        finally:
+            if self.streaming:
+                self.source.close()
+            self.timings['copy'] = time.time() - start
+            self.copied = True
+            if self.queue is not None:
+                self.queue.wake()
+
+    def check_codecs(self):
+        try:
+            decoder = self.decode[self.inext]
+        except KeyError:
+            log.debug("unable to decode " + self.inext)
+            raise KeyError("no available decoder for " + self.inext)
+        else:
+            decoder = decoder[program_index(decoder)]
+            if tools.find(decoder):
+                log.debug("can decode with " + tools.find(decoder))
+            else:
+                raise KeyError("It seems you do not have " + decoder +
+                    " installed, which is needed to decode " + self.inext +
+                    " files. Please install it using your package manager.")
+
+        try:
+            encoder = self.encode[self.tofmt]
+        except KeyError:
+            log.debug("unable to encode " + self.tofmt)
+            raise KeyError("no available encoder for " + self.tofmt)
+        else:
+            encoder = encoder[program_index(encoder)]
+            if tools.find(encoder):
+                log.debug("can encode with " + tools.find(encoder))
+            else:
+                raise KeyError("It seems you do not have " + encoder +
+                " installed, which is needed to encode " + self.tofmt +
+                " files. Please install it using your package manager.")
+
+    def prepare_files(self):
+        self.prepare_input()
+        self.prepare_output()
+
+    def prepare_input(self):
+        if urlparse.urlsplit(self.inurl)[0] == 'file':
+            self.infname = urllib.url2pathname(urlparse.urlsplit(self.inurl)[2])
+            self.infd = open(self.infname)
+            self.downloaded = False
+        elif self.inext not in self.seekable_decode:
+            # not a file url. stream it into the decoder as it arrives,
+            # keeping the start of the file for reading tags
+            self.download_start = time.time()
+            self.source = open_url(self.inurl)
+            headers = self.source.info()
+            validators = [headers.getheader(h) for h in
+                ('ETag', 'Last-Modified', 'Content-Length')]
+            if validators[0] or validators[1]:
+                self.remote_identity = "\0".join([self.inurl] +
+                    [str(v) for v in validators])
+            try:
+                self.insize = int(validators[2])
+            except (TypeError, ValueError):
+                pass
+            self.head = self.source.read(self.stream_head)
+            headfd, self.infname = tempfile.mkstemp(prefix="transcode-in-",
+                suffix="." + self.inext)
+            self._files_to_clean_up_on_success.append((headfd, self.infname))
+            self._files_to_clean_up_on_error.append((headfd, self.infname))
+            copy_to_fd(StringIO(self.head), headfd)
+            self.infd = subprocess.PIPE
+            self.downloaded = True
+            self.streaming = True
+        else:
+            # not a file url. download it.
+            download_start = time.time()
+            source = open_url(self.inurl)
+            self.infd, self.infname = tempfile.mkstemp(prefix="transcode-in-",
+                suffix="." + self.inext)
+            self._files_to_clean_up_on_success.append((self.infd, self.infname))
+            self._files_to_clean_up_on_error.append((self.infd, self.infname))
+            while True:
+                chunk = source.read(1024 * 64)
+                if not chunk:
+                    break
+                os.write(self.infd, chunk)
+            os.lseek(self.infd, 0, 0)
+            self.downloaded = True
+            self.timings['download'] = time.time() - download_start
+        if not self.streaming:
+            self.insize = os.path.getsize(self.infname)
+        log.debug("Reading from " + self.infname + " (" + self.inurl + ")")
+
+    def prepare_output(self):
+        if self.outdir:
+            # write next to the final destination, so that publish() is a
+            # rename rather than a copy
+            self.outfd, self.outfname = tempfile.mkstemp(
+                prefix=".transcode-out-", suffix="." + self.tofmt,
+                dir=self.outdir)
+        else:
+            self.outfd, self.outfname = tempfile.mkstemp(
+                prefix="transcode-out-", suffix="." + self.tofmt)
+        self._files_to_clean_up_on_error.append((self.outfd, self.outfname))
+        size = self.expected_output_size()
+        if size:
+            preallocate(self.outfd, size)
+
+        self.errfh, self.errfname = tempfile.mkstemp(prefix="transcode-",
+            suffix=".log")
+        self.outurl = urlparse.urlunsplit(
+            ["file", None, self.outfname, None, None])
+        self._files_to_clean_up_on_success.append((self.errfh, self.errfname))
+        log.debug("Outputting to " + self.outfname + " (" + self.outurl + ")")
+        log.debug("Errors to " + self.errfname)
+
+    def expected_output_size(self):
+        """Guess the size of the output from the size of the input"""
+        try:
+            return int(self.insize * self.bytes_per_second[self.tofmt] /
+                self.bytes_per_second[self.inext])
+        except (KeyError, TypeError):
+            return None
+
+    def trim_output(self):
+        """Give back any disk preallocated past the end of the output, and
+        note its size"""
+        self.bytes_out = os.fstat(self.outfd).st_size
+        # blocks reserved with FALLOC_FL_KEEP_SIZE outlive the file being
+        # closed, but truncating it, even to its own size, frees them
+        os.ftruncate(self.outfd, self.bytes_out)
+
+    def publish(self, filename):
+        """Move the finished output to filename"""
+        # mkstemp only lets us read the file, give it the usual permissions
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.outfname, 0666 & ~umask)
+        try:
+            os.rename(self.outfname, filename)
+        except OSError:
+            # a different filesystem to outdir
+            shutil.move(self.outfname, filename)
+        self.outfname = filename
+
+    def fetch_from_cache(self):
+        """Fill the output from the cache. Returns True on a hit."""
+        if self.cache is None:
+            return False
+        if self.streaming and self.remote_identity is None:
+            # we can't tell whether we've seen this stream before
+            return False
+        try:
+            # downloads have no stable identity, so key them on contents
+            self.cachekey = self.cache.key(self.infname, self.tofmt,
+                self.encode[self.tofmt], self.downloaded,
+                self.remote_identity)
+            self.cached = self.cache.fetch(self.cachekey, self.tofmt,
+                self.outfd)
+        except Exception:
+            log.exception("Cache lookup failed")
+            os.ftruncate(self.outfd, 0)
+            self.cached = False
+        os.lseek(self.outfd, 0, 0)
+        if self.cached and self.streaming and self.input_job is self:
+            # FanoutJob closes the stream itself, once no output needs it
+            self.source.close()
+        return self.cached
+
+    def store_in_cache(self):
+        if self.cache is None or self.cachekey is None:
+            return
+        try:
+            self.cache.store(self.cachekey, self.tofmt, self.outfname)
+        except Exception:
+            log.exception("Unable to store " + self.outfname + " in cache")
+
+    def start_codec(self):
+        taginfo = None
+        if self.tofmt in self.tagopt:
+            taginfo = self.read_tags()
+        self.taginfo = taginfo
+        encoder = self.encoder_command(taginfo)
+
+        self.decoder = self.encoder = None
+        if self.inext in self.passthrough and self.tofmt in self.passthrough:
+            # nothing to do but copy it
+            self.start_copy()
+            return
+
+        if self.inext in self.passthrough:
+            # the encoder can read the source itself
+            decoded = self.infd
+        else:
+            decoder = tools.resolve(self.decode[self.inext])
+            log.debug("decoder -> " + str(decoder))
+            if self.tofmt in self.passthrough:
+                # the decoder can write the output itself
+                self.decoder = self.spawn(decoder, stdin=self.infd,
+                    stdout=self.outfd, stderr=self.errfh)
+                self.start_input()
+                log.debug("Processes connected")
+                return
+            self.decoder = self.spawn(decoder,
+                stdin=self.infd, stdout=subprocess.PIPE, stderr=self.errfh)
+            decoded = self.decoder.stdout
+
+        log.debug("encoder -> " + str(encoder))
+        if self.decoder is not None and (self.pipe_buffer or
+                self.tofmt in self.normalise_wav):
+            self.encoder = self.spawn(encoder, stdin=subprocess.PIPE,
+                stdout=self.outfd, stderr=self.errfh)
+            sink = self.encoder.stdin
+            if self.tofmt in self.normalise_wav:
+                sink = RiffFilter(sink)
+            if self.pipe_buffer:
+                PipeBuffer(decoded, sink, self.pipe_buffer,
+                    self.timings).start()
+            else:
+                pump = threading.Thread(target=tee, args=(decoded, [sink]))
+                pump.setDaemon(True)
+                pump.start()
+        else:
+            self.encoder = self.spawn(encoder, stdin=decoded,
+                stdout=self.outfd, stderr=self.errfh)
+            if self.decoder is not None:
+                # the encoder has its own copy of the pipe now
+                self.decoder.stdout.close()
+        self.start_input()
+        log.debug("Processes connected")
+
+    def first_process(self):
+        """Return the process reading the source"""
+        return self.decoder or self.encoder
+
+    def last_process(self):
+        """Return the name of the process writing the output"""
+        if self.encoder is not None:
+            return 'encoder'
+        return 'decoder'
+
+    def spawn(self, command, **kwargs):
+        """Start one of the job's processes, applying any ChildLimits"""
+        # close_fds so that no child holds another's pipes open
+        kwargs['close_fds'] = True
+        if self.limits is not None:
+            command = self.limits.command(command)
+            kwargs['preexec_fn'] = self.limits.preexec
+        proc = subprocess.Popen(command, **kwargs)
+        proc.started = time.time()
+        if self.pipe_size:
+            for pipe in (proc.stdin, proc.stdout):
+                if pipe is not None:
+                    set_pipe_size(pipe, self.pipe_size)
+        return proc
+
+    def reap(self, name, proc=None):
+        """Collect the exit status and resource usage of the child process
+        proc, or self.<name>. Returns False if it is still running."""
+        if name in self.usage:
+            return True
+        if proc is None:
+            proc = getattr(self, name)
+        try:
+            pid, status, ru = os.wait4(proc.pid, os.WNOHANG)
+        except OSError, e:
+            if e.errno != errno.ECHILD:
+                raise
+            log.debug("%s of %s was already collected" % (name, self))
+            if proc.returncode is None:
+                proc.returncode = 0
+            self.usage[name] = {"wall": time.time() - proc.started}
+            return True
+        if pid == 0:
+            return False
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        self.usage[name] = {
+            "wall": time.time() - proc.started,
+            "user": ru.ru_utime,
+            "system": ru.ru_stime,
+            "maxrss_kb": ru.ru_maxrss,
+        }
+        return True
+
+    def start_input(self):
+        """Start streaming a remote source into the first process"""
+        if not self.streaming:
+            return
+        pump = threading.Thread(target=self.feed_decoder)
+        pump.setDaemon(True)
+        pump.start()
+
+    def feed_decoder(self):
+        sink = self.first_process().stdin
+        fed = 0
+        try:
+            try:
+                sink.write(self.head)
+                fed += len(self.head)
+                while True:
+                    try:
+                        chunk = self.source.read(1024 * 64)
+                    except IOError:
+                        # the download failed, so the job does too
+                        self.input_error = str(sys.exc_info()[1])
+                        break
+                    if not chunk:
+                        break
+                    sink.write(chunk)
+                    fed += len(chunk)
+            except IOError:
+                # the decoder stopped reading. If it exited cleanly it didn't
+                # need the rest (trailing tags, say), otherwise its exit
+                # status fails the job.
+                log.debug("decoder stopped reading after %d bytes" % fed)
+        finally:
+            try:
+                sink.close()
+            except IOError:
+                pass
+            self.source.close()
+            self.insize = fed
+            self.timings['download'] = time.time() - self.download_start
+
+    def encoder_command(self, taginfo):
+        """Assemble the command line for the encoder, including any tags or
+        the room to write them later"""
+        encoder = tools.resolve(self.encode[self.tofmt])
+
+        if taginfo and self.tofmt in tag_writers:
+            space = tag_size(self.tofmt, taginfo) + self.tag_slack
+            log.debug("  leaving %d bytes for tags" % space)
+            if self.tofmt == "ogg":
+                # each well short of the longest argument Linux allows
+                while space > 0:
+                    encoder[1:1] = ["-c",
+                        vorbis_padding + "=" + "." * min(space, 32768)]
+                    space -= 32768
+            else:
+                for opt in reversed(self.tagspace.get(self.tofmt, [])):
+                    encoder.insert(1, opt.replace('%d', str(space)))
+        elif self.tofmt in self.tagopt:
+            if taginfo:
+                for f in taginfo.allfields:
+                    if f in taginfo and f in self.tagopt[self.tofmt]:
+                        inf = taginfo[f]
+                        opt = self.tagopt[self.tofmt][f]
+                        log.debug("  %s = %s %s" % (f, opt, inf))
+                        # If we have a substitution, make it. If
+                        # not append the info as a separate
+                        # arg. Note that the tag options are
+                        # passed in as the second option because a
+                        # lot of programs don't parse options
+                        # after their file list.
+                        if type(inf) == type(u''):
+                            inf = inf.encode('utf8')
+                        else:
+                            inf = str(inf)
+                        if '%s' in opt:
+                            opt = opt.replace('%s', inf)
+                            encoder.insert(1, opt)
+                        else:
+                            encoder.insert(1, opt)
+                            encoder.insert(2, inf)
+        return encoder
+
+    def isfinished(self):
+        if self.endtime is not None:
+            return True
+
+        if self.errormsg is None and self.copying:
+            if not self.copied:
+                return False
+            if self.input_error:
+                self.errormsg = "Unable to copy " + self.inurl + "\n\n" + \
+                    self.input_error
+        elif self.errormsg is None and not self.cached:
+            last = self.last_process()
+            if not self.reap(last):
+                return False
+            if self.input_job is self and last != 'decoder' and \
+                    self.decoder is not None and not self.reap('decoder'):
+                return False
+            rtn = getattr(self, last).returncode
+            if rtn == 0 and self.decoder is not None:
+                # a decoder which failed part way through leaves a short
+                # output which the encoder is quite happy with. A FanoutJob
+                # has reaped its decoder before asking its outputs.
+                rtn = self.decoder.returncode
+
+            if rtn == 0 and self.input_job.input_error:
+                self.errormsg = "Unable to download " + self.inurl + \
+                    "\n\n" + self.input_job.input_error
+            elif rtn == 0:
+                self.errormsg = None
+                self.write_tags()
+                self.store_in_cache()
+            else:
+                log.debug("error in transcode, please review " +
+                    self.errfname)
+                self.errormsg = "Unable to transcode\n\n"
+                self.errormsg += open(self.errfname).read()
+
+        self.endtime = time.time()
+        if hasattr(self, 'outfd'):
+            self.trim_output()
+        self.record_result()
+        return True
+
+    def stats(self):
+        """Return a dict describing how the job went"""
+        record = {
+            "input": self.inurl,
+            "format": self.tofmt,
+            "ok": not self.errormsg,
+            "cached": self.cached,
+            "bytes_in": self.insize,
+            "bytes_out": self.bytes_out,
+        }
+        if self.errormsg:
+            record["error"] = self.errormsg.strip().split("\n")[0]
+        if self.endtime is not None and hasattr(self, 'starttime'):
+            record["total"] = self.endtime - self.starttime
+        record.update(self.timings)
+        record.update(self.usage)
+        return record
+
+    def read_tags(self):
+        start = time.time()
+        try:
+            if self.index and not self.downloaded:
+                taginfo = self.index.tags(self.infname, self.inext)
+            else:
+                taginfo = get_tags(self.infname, self.inext)
+            # cover art is too big for the index, but it's cheap to read
+            # from the start of the file. A streamed source only has its
+            # first stream_head bytes on disk, which could cut it short.
+            if taginfo is not None and not self.streaming:
+                try:
+                    picture = read_picture(self.infname, self.inext)
+                except Exception:
+                    log.exception("Unable to read cover art from " +
+                        self.infname)
+                    picture = None
+                if picture is not None:
+                    taginfo['picture'] = picture
+            return taginfo
+        finally:
+            self.timings['tags'] = time.time() - start
+
+    def write_tags(self):
+        """Write the tags of the source into the output, in the room the
+        encoder left for them"""
+        if not self.taginfo or self.tofmt not in tag_writers:
+            return
+        start = time.time()
+        try:
+            try:
+                if not write_tags(self.outfname, self.tofmt, self.taginfo):
+                    log.debug("No room for the tags in " + self.outfname)
+            except Exception:
+                log.exception("Unable to write tags to " + self.outfname)
+        finally:
+            self.timings['tag_write'] = time.time() - start
+
+    def audio_length(self):
+        if self.index and not self.downloaded:
+            return self.index.length(self.infname, self.inext)
+        return audio_length(self.infname, self.inext)
+
+    def record_result(self):
+        if not self.index or getattr(self, 'downloaded', True):
+            return
+        try:
+            self.index.record_transcode(self.infname, self.tofmt,
+                self.errormsg, self.endtime - self.starttime)
+        except Exception:
+            log.exception("Unable to record the result of " + str(self))
+
+    def clean_up(self):
+        # downloaded inputs are in both lists, so only close them once
+        closed = set()
+        for (fd, filename) in self._files_to_clean_up_on_error + \
+                self._files_to_clean_up_on_success:
+            if fd not in closed:
+                os.close(fd)
+                closed.add(fd)
+        if self.errormsg:
+            list_of_files = self._files_to_clean_up_on_error
+        else:
+            list_of_files = self._files_to_clean_up_on_success
+        for (fd, filename) in list_of_files:
+            log.debug("deleting " + filename)
+            try:
+                os.unlink(filename)
+            except Exception:
+                pass
+
+    def slots(self):
+        """Return how many of QueueMgr.maxjobs the job is using"""
+        return 1
+
+    def key(self):
+        """Return what makes this job the same as another"""
+        return (self.inurl, self.tofmt, self.dest)
+
+    def share_result(self, job):
+        """Finish as a duplicate of job, which has just finished"""
+        for name in ('errormsg', 'cached', 'infname', 'insize', 'outfname',
+                'outurl', 'starttime', 'endtime', 'bytes_out'):
+            if hasattr(job, name):
+                setattr(self, name, getattr(job, name))
+
+    def temp_files(self):
+        """Return the names of the temporary files made for the job"""
+        names = set()
+        for (fd, filename) in self._files_to_clean_up_on_error + \
+                self._files_to_clean_up_on_success:
+            names.add(filename)
+        return list(names)
+
+    def __str__(self):
+        return "TranscodeJob(" + self.inurl + ", " + self.tofmt + ")"
+    __repr__ = __str__
+
+
+class FanoutJob(TranscodeJob):
+    """Transcode one source to several formats, decoding it only once.
+
+    Each format is handled by a TranscodeJob in self.jobs which owns the
+    output, cache entry and encoder for that format. A single decoder feeds
+    all the encoders through a thread running tee().
+    """
+
+    def __init__(self, _inurl, _tofmts):
+        TranscodeJob.__init__(self, _inurl, ",".join(_tofmts))
+        self.jobs = [TranscodeJob(_inurl, tofmt) for tofmt in _tofmts]
+
+    def cost(self):
+        # one decode, but an encode for each format
+        decode = self.decode_cost.get(self.inext, 1.0)
+        weight = decode
+        for job in self.jobs:
+            weight += max(job.weight(job.tofmt) - decode, 0)
+        return self.source_length() * weight
+
+    def start(self):
+        log.debug("Starting fan-out job")
+        self.starttime = time.time()
+        self.timings['queue_wait'] = self.starttime - self.queuedtime
+        try:
+            pending = []
+            for job in self.jobs:
+                job.starttime = self.starttime
+                job.queue = self.queue
+                try:
+                    if not job.same_codec():
+                        job.check_codecs()
+                except KeyError:
+                    log.exception("Failed to start")
+                    job.errormsg = str(sys.exc_info()[1])
+                else:
+                    pending.append(job)
+            if pending:
+                self.prepare_input()
+            for job in pending[:]:
+                for attr in ('infd', 'infname', 'downloaded', 'streaming',
+                        'remote_identity', 'insize'):
+                    setattr(job, attr, getattr(self, attr))
+                job.input_job = self
+                job.prepare_output()
+                if job.same_codec():
+                    # a streamed source can only be read once, by the decoder
+                    if not self.streaming and job.bitrate_ok():
+                        job.start_copy()
+                        pending.remove(job)
+                        continue
+                    try:
+                        job.check_codecs()
+                    except KeyError:
+                        log.exception("Failed to start")
+                        job.errormsg = str(sys.exc_info()[1])
+                        pending.remove(job)
+                        continue
+                if job.fetch_from_cache():
+                    pending.remove(job)
+            if pending:
+                self.start_codec(pending)
+            elif self.streaming:
+                self.source.close()
+        except Exception:
+            log.exception("Failed to start")
+            self.errormsg = str(sys.exc_info()[1])
+
+    def start_codec(self, jobs):
+        taginfo = None
+        for job in jobs:
+            if job.tofmt in job.tagopt:
+                taginfo = self.read_tags()
+                break
+
+        self.decoder = None
+        if self.inext in self.passthrough and not self.streaming:
+            # tee can read the source itself
+            if self.downloaded:
+                decoded = os.fdopen(os.dup(self.infd), 'rb')
+            else:
+                decoded = self.infd
+        else:
+            decoder = tools.resolve(self.decode[self.inext])
+            log.debug("decoder -> " + str(decoder))
+            self.decoder = self.spawn(decoder, stdin=self.infd,
+                stdout=subprocess.PIPE, stderr=jobs[0].errfh)
+            decoded = self.decoder.stdout
+        sinks = []
+        for job in jobs:
+            job.taginfo = taginfo
+            encoder = job.encoder_command(taginfo)
+            log.debug("encoder -> " + str(encoder))
+            job.decoder = self.decoder
+            job.encoder = self.spawn(encoder, stdin=subprocess.PIPE,
+                stdout=job.outfd, stderr=job.errfh)
+            if self.decoder is not None and job.tofmt in job.normalise_wav:
+                sinks.append(RiffFilter(job.encoder.stdin))
+            else:
+                sinks.append(job.encoder.stdin)
+        pump = threading.Thread(target=tee, args=(decoded, sinks))
+        pump.setDaemon(True)
+        pump.start()
+        self.start_input()
+        log.debug("Processes connected")
+
+    def isfinished(self):
+        if self.endtime is not None:
+            return True
+
+        if self.errormsg is None:
+            # the outputs need the decoder's exit status
+            if getattr(self, 'decoder', None) and not self.reap('decoder'):
+                return False
+            for job in self.jobs:
+                if not job.isfinished():
+                    return False
+        self.endtime = time.time()
+        return True
+
+    def stats(self):
+        record = TranscodeJob.stats(self)
+        del record["ok"], record["cached"], record["bytes_out"]
+        record["outputs"] = []
+        for job in self.jobs:
+            output = job.stats()
+            # the input belongs to this job, not the outputs
+            del output["bytes_in"]
+            record["outputs"].append(output)
+        if self.errormsg:
+            for output in record["outputs"]:
+                output["ok"] = False
+        return record
+
+    def key(self):
+        return tuple([self.inurl] + [job.key() for job in self.jobs])
+
+    def share_result(self, job):
+        TranscodeJob.share_result(self, job)
+        for mine, theirs in zip(self.jobs, job.jobs):
+            mine.share_result(theirs)
+
+    def temp_files(self):
+        names = TranscodeJob.temp_files(self)
+        for job in self.jobs:
+            names += job.temp_files()
+        return names
+
+    def clean_up(self):
+        for job in self.jobs:
+            job.clean_up()
+        TranscodeJob.clean_up(self)
+
+
+class SplitJob(TranscodeJob):
+    """Transcode a long source in segments which are encoded in parallel.
+
+    The source is decoded to a temporary wav file, which is cut into as many
+    segments as there are job slots nothing else in the queue wants, each at
+    least split_min seconds long and a whole number of the encoder's frames.
+    The segments are all encoded at once and then joined: ogg files chain
+    together without a gap (though some players won't play a chained stream,
+    and only the first link has tags), and mp3 files are concatenated by
+    join_mp3(). Each mp3 segment is encoded with a few frames of its
+    neighbours on either side, which join_mp3() trims off again, so that the
+    encoder's delay and padding don't leave gaps where they meet.
+    Short sources, or a busy queue, are transcoded as a single TranscodeJob.
+    """
+
+    # Sources at least this long (in seconds) are split, or 0 for never
+    split_over = 0
+
+    # Samples per frame of the formats whose segments can be joined
+    frame_samples = {"mp3": 1152, "ogg": 1}
+
+    # Frames of its neighbours each segment is encoded with on either side
+    overlap_frames = {"mp3": 2}
+
+    # Encoder options for segments. The frames join_mp3() keeps can't use
+    # lame's bit reservoir, which would leave part of them in the frames it
+    # trims.
+    segment_options = {"mp3": ["--nores"]}
+
+    # Shortest segment, in seconds
+    split_min = 60
+
+    def __init__(self, _inurl, _tofmt):
+        TranscodeJob.__init__(self, _inurl, _tofmt)
+        self.nsegments = 1
+        # (encoder, output filename) of each segment
+        self.segments = []
+        # (frames to skip, frames to keep or None for the rest) of each
+        # segment's output
+        self.trims = []
+        self.pcmname = None
+
+    def slots(self):
+        return self.nsegments
+
+    def segment_count(self):
+        """Decide how many segments to split the source into"""
+        if self.queue is None or self.same_codec():
+            return 1
+        length = self.source_length()
+        if length < self.split_over:
+            return 1
+        free = self.queue.maxjobs - self.queue.used_slots() - \
+            len(self.queue.queuedjobs)
+        return max(1, min(free, int(length // self.split_min)))
+
+    def start(self):
+        self.nsegments = self.segment_count()
+        if self.nsegments < 2:
+            TranscodeJob.start(self)
+            return
+        log.debug("Starting job in %d segments" % self.nsegments)
+        self.starttime = time.time()
+        self.timings['queue_wait'] = self.starttime - self.queuedtime
+        self.decoder = self.encoder = None
+        try:
+            self.check_codecs()
+            self.prepare_files()
+            if self.fetch_from_cache():
+                return
+            if self.tofmt in self.tagopt:
+                self.taginfo = self.read_tags()
+            if self.inext in self.passthrough and not self.streaming:
+                self.pcmname = self.infname
+                self.start_segments()
+                return
+            pcmfd, self.pcmname = tempfile.mkstemp(prefix="transcode-pcm-",
+                suffix=".wav")
+            self._files_to_clean_up_on_success.append((pcmfd, self.pcmname))
+            self._files_to_clean_up_on_error.append((pcmfd, self.pcmname))
+            decoder = tools.resolve(self.decode[self.inext])
+            log.debug("decoder -> " + str(decoder))
+            self.decoder = self.spawn(decoder, stdin=self.infd, stdout=pcmfd,
+                stderr=self.errfh)
+            self.start_input()
+        except Exception:
+            log.exception("Failed to start")
+            self.errormsg = str(sys.exc_info()[1])
+
+    def start_segments(self):
+        """Start encoding each segment of the decoded source"""
+        fh = open(self.pcmname, 'rb')
+        try:
+            fmt, offset, size = wav_layout(fh)
+        finally:
+            fh.close()
+        align = wav_block_align(fmt)
+        frames = size // align
+        unit = self.frame_samples[self.tofmt]
+        # round up, so the last segment is the short one
+        per_segment = -(-frames // self.nsegments)
+        per_segment = -(-per_segment // unit) * unit
+        overlap = self.overlap_frames.get(self.tofmt, 0) * unit
+        for start in range(0, frames, max(per_segment, 1)):
+            count = min(per_segment, frames - start)
+            before = min(overlap, start)
+            after = min(overlap, frames - start - count)
+            if after:
+                self.trims.append((before // unit, count // unit))
+            else:
+                self.trims.append((before // unit, None))
+            if self.segments:
+                encoder = self.encoder_command(None)
+            else:
+                encoder = self.encoder_command(self.taginfo)
+            encoder[1:1] = self.segment_options.get(self.tofmt, [])
+            log.debug("segment encoder -> " + str(encoder))
+            fd, filename = tempfile.mkstemp(prefix="transcode-segment-",
+                suffix="." + self.tofmt)
+            self._files_to_clean_up_on_success.append((fd, filename))
+            self._files_to_clean_up_on_error.append((fd, filename))
+            encoder = self.spawn(encoder, stdin=subprocess.PIPE, stdout=fd,
+                stderr=self.errfh)
+            self.segments.append((encoder, filename))
+            feeder = threading.Thread(target=self.feed_segment,
+                args=(encoder.stdin,
+                wav_header(fmt, (before + count + after) * align),
+                offset + (start - before) * align,
+                (before + count + after) * align))
+            feeder.setDaemon(True)
+            feeder.start()
+
+    def feed_segment(self, sink, header, start, length):
+        fh = open(self.pcmname, 'rb')
+        try:
+            try:
+                sink.write(header)
+                fh.seek(start)
+                while length > 0:
+                    chunk = fh.read(min(length, 1024 * 64))
+                    if not chunk:
+                        break
+                    sink.write(chunk)
+                    length -= len(chunk)
+            except IOError:
+                log.debug("lost a segment encoder")
+        finally:
+            fh.close()
+            try:
+                sink.close()
+            except IOError:
+                pass
+
+    def isfinished(self):
+        if self.nsegments < 2 or self.endtime is not None or \
+                self.errormsg is not None or self.cached:
+            return TranscodeJob.isfinished(self)
+
+        if not self.segments:
+            # still decoding
+            if not self.reap('decoder'):
+                return False
+            if self.input_error:
+                self.errormsg = "Unable to download " + self.inurl + \
+                    "\n\n" + self.input_error
+            elif self.decoder.returncode != 0:
+                self.errormsg = "Unable to transcode\n\n" + \
+                    open(self.errfname).read()
+            else:
+                try:
+                    self.start_segments()
+                    return False
+                except (IOError, OSError, ValueError):
+                    log.exception("Failed to split")
+                    self.errormsg = "Unable to split " + self.inurl + \
+                        "\n\n" + str(sys.exc_info()[1])
+            return TranscodeJob.isfinished(self)
+
+        for i in range(len(self.segments)):
+            if not self.reap('encoder%d' % i, self.segments[i][0]):
+                return False
+        self.merge_usage()
+        for encoder, filename in self.segments:
+            if encoder.returncode != 0:
+                self.errormsg = "Unable to transcode\n\n" + \
+                    open(self.errfname).read()
+                return TranscodeJob.isfinished(self)
+        try:
+            self.join_segments()
+        except (IOError, OSError):
+            log.exception("Failed to join")
+            self.errormsg = "Unable to join the segments of " + self.inurl + \
+                "\n\n" + str(sys.exc_info()[1])
+            return TranscodeJob.isfinished(self)
+        self.write_tags()
+        self.store_in_cache()
+        self.endtime = time.time()
+        self.trim_output()
+        self.record_result()
+        return True
+
+    def merge_usage(self):
+        """Add up the usage of the segment encoders for stats()"""
+        total = {"wall": 0.0, "user": 0.0, "system": 0.0, "maxrss_kb": 0}
+        for i in range(len(self.segments)):
+            usage = self.usage.pop('encoder%d' % i)
+            total["wall"] = max(total["wall"], usage["wall"])
+            total["maxrss_kb"] = max(total["maxrss_kb"],
+                usage.get("maxrss_kb", 0))
+            total["user"] += usage.get("user", 0)
+            total["system"] += usage.get("system", 0)
+        self.usage["encoder"] = total
+
+    def join_segments(self):
+        filenames = [filename for encoder, filename in self.segments]
+        log.debug("joining %d segments" % len(filenames))
+        if self.tofmt == "mp3":
+            join_mp3(filenames, self.outfd, self.trims)
+            return
+        for filename in filenames:
+            fh = open(filename, 'rb')
+            try:
+                copy_to_fd(fh, self.outfd)
+            finally:
+                fh.close()
+
+
+############################################################################
+# amaKode
+############################################################################
+
+
+class amaKode(object):
+    """The main application"""
+
+    def __init__(self):
+        """Main loop waits for something to do then does it"""
+        self.queue = QueueMgr(callback=self.job_finished)
+        resume_jobs(self.queue, None)
+
+    def run(self):
+        log.debug("Started.")
+        while True:
+            # Check for finished jobs, etc
+            self.queue.poll()
+            # Sleep until a child exits or there's something on stdin
+            ready = self.queue.wait([sys.stdin.fileno()])
+            if sys.stdin.fileno() in ready:
+                # Let's hope we got a whole line or we stall here
+                line = sys.stdin.readline()
+                if line:
+                    self.customEvent(line)
+                else:
+                    log.debug("exiting...")
+                    notifier.flush()
+                    break
+
+    def customEvent(self, line):
+        """Handles notifications"""
+
+        if line.startswith("transcode"):
+            self.transcode(str(line))
+
+        if line.startswith("quit"):
+            self.quit()
+
+        if line.startswith("configure"):
+            self.configure()
+
+        if line.startswith("stats"):
+            self.stats()
+
+        if line.startswith("rescan"):
+            log.debug("looking for external programs again")
+            tools.refresh()
+
+    def transcode(self, line):
+        """Called when requested to transcode a track"""
+        args = line.split()
+        if len(args) != 3:
+            log.debug("Invalid transcode command")
+            return
+
+        log.debug("transcoding " + args[1] + " to " + args[2])
+
+        newjob = new_job(args[1], [args[2]])[0]
+        self.queue.add(newjob)
+
+    def job_finished(self, job):
+        self.notify_amarok_that_job_is_finished(job)
+        job.clean_up()
+
+    def notify_amarok_that_job_is_finished(self, job):
+        """Report to amarok that the job is done"""
+        if job.errormsg:
+            log.debug("Job " + job.inurl + " failed - " + job.errormsg)
+            notifier.call('mediabrowser', 'transcodingFinished', job.inurl, '')
+            # get Amarok to pop up our error message
+            notifier.popup(job.errormsg)
+        else:
+            log.debug("Job " + job.inurl + " completed successfully")
+            notifier.call('mediabrowser', 'transcodingFinished', job.inurl,
+                job.outurl)
+
+    def stats(self):
+        """Print the performance totals"""
+        report = self.queue.stats.report()
+        log.debug("stats: " + report)
+        print report
+        sys.stdout.flush()
+
+    def quit(self):
+        log.debug("quitting")
+        notifier.flush()
+        sys.exit()
+
+    def configure(self):
+        subprocess.call(["kdialog", "--title", "Amakode", "--msgbox",
+            "Amakode can be configured using Amarok's media device settings."])
+
+
+class Daemon(object):
+    """Runs the jobs of commandline invocations which connect to a Unix
+    socket, so that they share one queue (and one limit on the number of
+    jobs), the external programs found and the index, instead of each
+    starting from scratch.
+
+    Clients send lines of tab separated fields (escaped like python
+    strings):
+
+        settings <name>=<value>...
+        transcode <source url> <format> <destination> [<format> <destination>]...
+        status
+        wait
+
+    settings gives the job settings from the client's commandline (see
+    client_settings()) for the transcodes it asks for after it. The daemon's
+    limit on the number of jobs is shared, so a client asking for a different
+    one is sent a warning instead.
+
+    Each output of a transcode request is answered when it finishes with
+
+        done <destination> ok <seconds> <audio seconds>
+        done <destination> failed <error message>
+
+    status is answered with "status" followed by name=value fields, and wait
+    with "idle" once every transcode the client asked for is done.
+    """
+
+    def __init__(self, options):
+        self.path = options.socket
+        self.queue = QueueMgr(callback=self.job_finished,
+            maxjobs=options.jobs)
+        self.listener = None
+        # DaemonClients by file descriptor
+        self.clients = {}
+        # destination, and the DaemonClient to tell, of each output
+        self.destinations = {}
+        self.requesters = {}
+
+    def listen(self):
+        if os.path.exists(self.path):
+            sock = daemon_connect(self.path)
+            if sock is not None:
+                sock.close()
+                sys.exit("amakode is already running at " + self.path)
+            log.debug("removing stale socket " + self.path)
+            os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # only our user can connect
+        umask = os.umask(077)
+        try:
+            self.listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        atexit.register(self.close)
+        self.listener.listen(16)
+        log.debug("listening on " + self.path)
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            os.unlink(self.path)
+
+    def run(self):
+        self.listen()
+        for output in resume_jobs(self.queue, self.destinations):
+            self.requesters[output] = None
+        while True:
+            self.queue.poll()
+            fds = [self.listener.fileno()] + self.clients.keys()
+            for fd in self.queue.wait(fds):
+                if fd == self.listener.fileno():
+                    sock = self.listener.accept()[0]
+                    self.clients[sock.fileno()] = DaemonClient(sock)
+                elif fd in self.clients:
+                    self.receive(self.clients[fd])
+
+    def receive(self, client):
+        try:
+            data = client.sock.recv(1024 * 64)
+        except socket.error:
+            data = ""
+        if not data:
+            # any jobs it asked for carry on, we just can't reply
+            self.drop(client)
+            return
+        client.buffer += data
+        lines = client.buffer.split("\n")
+        client.buffer = lines.pop()
+        for line in lines:
+            try:
+                fields = split_fields(line)
+            except ValueError:
+                self.reply(client, "error", "bad request")
+                continue
+            self.request(client, fields)
+
+    def request(self, client, fields):
+        if fields[0] == "transcode" and len(fields) >= 4 and \
+                len(fields) % 2 == 0:
+            self.transcode(client, fields[1], fields[2::2], fields[3::2])
+        elif fields[0] == "status":
+            self.reply(client, "status",
+                "active=%d" % len(self.queue.activejobs),
+                "queued=%d" % (len(self.queue.queuedjobs)),
+                "maxjobs=%d" % self.queue.maxjobs,
+                "clients=%d" % len(self.clients),
+                self.queue.stats and self.queue.stats.report() or "")
+        elif fields[0] == "wait":
+            client.waiting = True
+            self.check_idle(client)
+        elif fields[0] == "settings":
+            self.settings(client, fields[1:])
+        else:
+            self.reply(client, "error", "bad request")
+
+    def settings(self, client, fields):
+        try:
+            client.settings = parse_settings(fields)
+        except ValueError:
+            self.reply(client, "error", "bad settings: %s" % sys.exc_info()[1])
+            return
+        jobs = client.settings.pop("jobs", None)
+        if jobs is not None and jobs != self.queue.maxjobs:
+            self.reply(client, "warning", "-j %d ignored, the daemon runs up "
+                "to %d jobs for all its clients" % (jobs, self.queue.maxjobs))
+
+    def transcode(self, client, url, formats, dests):
+        log.debug("transcoding %s to %s for a client" % (url, formats))
+        job, outputs = new_job(url, formats,
+            client.settings.get("split_over"))
+        apply_settings(job, client.settings)
+        for output, dest in zip(outputs, dests):
+            self.requesters[output] = client
+            client.pending += 1
+            try:
+                set_destination(output, dest, self.destinations)
+            except OSError:
+                job.errormsg = str(sys.exc_info()[1])
+        if job.errormsg:
+            self.job_finished(job)
+        else:
+            self.queue.add(job)
+
+    def job_finished(self, job):
+        log.debug('FINISHED %r, errormsg=%s' % (job, job.errormsg))
+        for output, dest, errormsg in publish_outputs(job, self.destinations):
+            client = self.requesters.pop(output, None)
+            if client is None:
+                # resumed from the journal, nobody is waiting for it
+                continue
+            client.pending -= 1
+            if errormsg:
+                self.reply(client, "done", dest, "failed", errormsg)
+            else:
+                self.reply(client, "done", dest, "ok",
+                    "%.3f" % (output.endtime - output.starttime),
+                    "%.1f" % (output.audio_length() or 0))
+            self.check_idle(client)
+        job.clean_up()
+
+    def check_idle(self, client):
+        if client.waiting and not client.pending:
+            client.waiting = False
+            self.reply(client, "idle")
+
+    def reply(self, client, *fields):
+        if client.sock is None:
+            return
+        try:
+            send_request(client.sock, *fields)
+        except socket.error:
+            log.debug("lost a client")
+            self.drop(client)
+
+    def drop(self, client):
+        if client.sock is not None:
+            del self.clients[client.sock.fileno()]
+            client.sock.close()
+            client.sock = None
+
+
+class DaemonClient(object):
+    """A connection to the Daemon"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = ""
+        # outputs still to be reported
+        self.pending = 0
+        # whether to say "idle" once pending is 0
+        self.waiting = False
+        # job settings from parse_settings()
+        self.settings = {}
+
+############################################################################
+
+
+class RiffFilter(object):
+    """Write a wav stream to the file sink, rewriting its header into a
+    canonical form.
+
+    A decoder writing to a pipe can't go back and fill in the sizes in the
+    header when it's finished, and some encoders won't accept what it writes
+    instead. The header is replaced by one with just the fmt and data chunks,
+    claiming as much data as a wav file can hold. Everything after the header
+    is passed through untouched."""
+
+    # give up looking for the data chunk after this much header
+    max_header = 1024 * 1024
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.buffer = ""
+        self.done = False
+
+    def write(self, chunk):
+        chunk = self.filter(chunk)
+        if chunk:
+            self.sink.write(chunk)
+
+    def close(self):
+        try:
+            rest = self.flush()
+            if rest:
+                self.sink.write(rest)
+        finally:
+            self.sink.close()
+
+    def filter(self, chunk):
+        """Return the next part of the filtered stream"""
+        if self.done:
+            return chunk
+        self.buffer += chunk
+        if self.buffer[:4] != "RIFF"[:len(self.buffer)] or \
+                len(self.buffer) > self.max_header:
+            log.debug("not rewriting wav header")
+            return self.flush()
+        if len(self.buffer) < 12:
+            return ""
+        if self.buffer[8:12] != "WAVE":
+            return self.flush()
+        fmt = None
+        offset = 12
+        while offset + 8 <= len(self.buffer):
+            chunkid = self.buffer[offset:offset + 4]
+            size = struct.unpack("<I", self.buffer[offset + 4:offset + 8])[0]
+            if chunkid == "data":
+                if fmt is None:
+                    return self.flush()
+                header = wav_header(fmt)
+                data = self.buffer[offset + 8:]
+                self.buffer = ""
+                self.done = True
+                return header + data
+            end = offset + 8 + size + (size & 1)
+            if end > len(self.buffer):
+                break
+            if chunkid == "fmt ":
+                fmt = self.buffer[offset + 8:offset + 8 + size]
+            offset = end
+        return ""
+
+    def flush(self):
+        """Return whatever is left at the end of the stream"""
+        rest = self.buffer
+        self.buffer = ""
+        self.done = True
+        return rest
+
+
+
+class PipeBuffer(object):
+    """Copy from the file source to the file sink through a buffer of up to
+    limit bytes, so that the processes either side can each run for longer
+    between waits.
+
+    One thread reads and another writes. The time the reader spends waiting
+    for space (the encoder is behind) is added to timings["decoder_stall"]
+    and the time the writer spends waiting for data (the decoder is behind)
+    to timings["encoder_stall"]."""
+
+    chunk_size = 1024 * 64
+
+    def __init__(self, source, sink, limit, timings):
+        self.source = source
+        self.sink = sink
+        self.limit = max(limit, self.chunk_size)
+        self.timings = timings
+        self.chunks = collections.deque()
+        self.size = 0
+        self.eof = False
+        self.broken = False
+        self.lock = threading.Condition()
+
+    def start(self):
+        for target in (self.read, self.write):
+            thread = threading.Thread(target=target)
+            thread.setDaemon(True)
+            thread.start()
+
+    def read(self):
+        stalled = 0.0
+        try:
+            while True:
+                chunk = os.read(self.source.fileno(), self.chunk_size)
+                self.lock.acquire()
+                try:
+                    if self.broken:
+                        break
+                    if not chunk:
+                        break
+                    if self.size + len(chunk) > self.limit:
+                        start = time.time()
+                        while self.size + len(chunk) > self.limit and \
+                                not self.broken:
+                            self.lock.wait()
+                        stalled += time.time() - start
+                    self.chunks.append(chunk)
+                    self.size += len(chunk)
+                    self.lock.notify()
+                finally:
+                    self.lock.release()
+        finally:
+            self.lock.acquire()
+            try:
+                self.eof = True
+                self.timings["decoder_stall"] = stalled
+                self.lock.notify()
+            finally:
+                self.lock.release()
+            self.source.close()
+
+    def write(self):
+        stalled = 0.0
+        try:
+            while True:
+                self.lock.acquire()
+                try:
+                    if not self.chunks and not self.eof:
+                        start = time.time()
+                        while not self.chunks and not self.eof:
+                            self.lock.wait()
+                        stalled += time.time() - start
+                    if not self.chunks:
+                        break
+                    chunk = self.chunks.popleft()
+                    self.size -= len(chunk)
+                    self.lock.notify()
+                finally:
+                    self.lock.release()
+                try:
+                    self.sink.write(chunk)
+                except IOError:
+                    log.debug("lost the output of a PipeBuffer")
+                    self.lock.acquire()
+                    try:
+                        self.broken = True
+                        self.chunks.clear()
+                        self.lock.notify()
+                    finally:
+                        self.lock.release()
+                    break
+        finally:
+            self.timings["encoder_stall"] = stalled
+            try:
+                self.sink.close()
+            except IOError:
+                pass
+
+
+class ToolRegistry(object):
+    """Finds the external programs we run.
+
+    Each program is looked up on the PATH the first time it is needed and
+    the result is remembered, so jobs don't have to search the PATH again.
+    Call refresh() (or send SIGHUP) after installing new programs.
+    """
+
+    def __init__(self):
+        self.paths = {}
+        self.versions = {}
+
+    def find(self, name):
+        """Return the absolute path of the program name, or None"""
+        try:
+            return self.paths[name]
+        except KeyError:
+            path = search_path(name)
+            self.paths[name] = path
+            return path
+
+    def version(self, name):
+        """Return the first line of output of `name --version`"""
+        try:
+            return self.versions[name]
+        except KeyError:
+            pass
+        version = "unknown version"
+        path = self.find(name)
+        if path:
+            try:
+                null = open(os.devnull)
+                try:
+                    p = subprocess.Popen([path, '--version'], stdin=null,
+                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                    lines = [l.strip() for l in p.stdout.readlines()]
+                    p.wait()
+                finally:
+                    null.close()
+                lines = [l for l in lines if l]
+                if lines:
+                    version = lines[0]
+            except (OSError, IOError):
+                pass
+        self.versions[name] = version
+        return version
+
+    def resolve(self, command):
+        """Return a copy of command with its programs made absolute"""
+        command = list(command)
+        for i in set([0, program_index(command)]):
+            path = self.find(command[i])
+            if path:
+                command[i] = path
+        return command
+
+    def refresh(self):
+        # no logging here, this is called from a signal handler
+        self.paths = {}
+        self.versions = {}
+
+tools = ToolRegistry()
+
+
+class Notifier(object):
+    """Sends messages to Amarok with dcop without holding up the jobs.
+
+    Calls are queued and made in order by a worker thread. Popup messages
+    are shown at most every popup_interval seconds; any that arrive in
+    between are combined into the next one."""
+
+    command = ['dcop', 'amarok']
+    popup_interval = 10
+    # most messages to show in one popup
+    max_popups = 5
+
+    def __init__(self):
+        self.calls = collections.deque()
+        self.popups = []
+        self.last_popup = 0
+        self.busy = False
+        self.flushing = False
+        self.thread = None
+        self.lock = threading.Condition()
+
+    def call(self, *args):
+        """Queue a dcop call to amarok with args"""
+        self.lock.acquire()
+        try:
+            self.calls.append(args)
+            self.start()
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+    def popup(self, message):
+        """Queue a popup message"""
+        self.lock.acquire()
+        try:
+            if message not in self.popups:
+                self.popups.append(message)
+            self.start()
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+            atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            self.lock.acquire()
+            try:
+                self.busy = False
+                args = self.next_call()
+                self.busy = True
+            finally:
+                self.lock.release()
+            self.dcop(args)
+
+    def next_call(self):
+        """Wait for the next call to make. Must hold self.lock"""
+        while True:
+            if self.calls:
+                return self.calls.popleft()
+            # let flush() know the calls are done
+            self.lock.notifyAll()
+            if self.popups:
+                wait = self.last_popup + self.popup_interval - time.time()
+                if wait <= 0 or self.flushing:
+                    self.last_popup = time.time()
+                    return ('playlist', 'popupMessage', self.combine())
+                self.lock.wait(wait)
+            else:
+                self.lock.wait()
+
+    def combine(self):
+        messages = self.popups
+        self.popups = []
+        extra = len(messages) - self.max_popups
+        message = "\n\n".join(messages[:self.max_popups])
+        if extra > 0:
+            message += "\n\n(and %d more)" % extra
+        return message
+
+    def dcop(self, args):
+        try:
+            subprocess.call(self.command + list(args), close_fds=True)
+        except OSError, e:
+            log.debug("unable to run dcop: " + str(e))
+
+    def flush(self, timeout=5):
+        """Wait up to timeout seconds for the queued calls and popups to be
+        made"""
+        deadline = time.time() + timeout
+        self.lock.acquire()
+        try:
+            self.flushing = True
+            self.lock.notifyAll()
+            while (self.calls or self.popups or self.busy) and \
+                    time.time() < deadline:
+                self.lock.wait(deadline - time.time())
+        finally:
+            self.flushing = False
+            self.lock.release()
+
+notifier = Notifier()
+
+
+def program_index(command):
+    """Return the index of the program run by command, skipping env"""
+
+    i = 0
+    if os.path.basename(command[0]) == 'env':
+        i = 1
+        while i < len(command) - 1 and '=' in command[i] and \
+                not command[i].startswith('-'):
+            i += 1
+    return i
+
+
+def search_path(name):
+    """Return the absolute path of the executable name on PATH, or None"""
+
+    path = os.environ.get('PATH')
+    if not path:
+        path = os.defpath
+    for directory in path.split(os.pathsep):
+        candidate = os.path.abspath(os.path.join(directory, name))
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def audio_length(filename, ext):
+    """Return the playing time of filename in seconds, or None if unknown"""
+
+    try:
+        if ext == "wav":
+            w = wave.open(filename)
+            try:
+                return float(w.getnframes()) / w.getframerate()
+            finally:
+                w.close()
+        elif tagpy:
+            return tagpy.FileRef(filename).audioProperties().length
+    except Exception:
+        log.debug("unable to find the length of " + filename)
+    return None
+
+
+_fallocate = None
+def preallocate(fd, size):
+    """Reserve size bytes of disk for fd without changing its length, if the
+    platform can"""
+
+    global _fallocate
+    if _fallocate is None:
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'))
+            _fallocate = libc.fallocate64
+            _fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                ctypes.c_longlong, ctypes.c_longlong]
+        except Exception:
+            _fallocate = False
+    if _fallocate:
+        # 1 is FALLOC_FL_KEEP_SIZE. Failure doesn't matter, it's only a hint.
+        _fallocate(fd, 1, 0, size)
+
+
+def open_url(url):
+    """urllib.urlopen, but raise IOError for HTTP errors"""
+
+    source = urllib.urlopen(url)
+    code = getattr(source, 'code', None)
+    if code is not None and code >= 400:
+        source.close()
+        raise IOError("Unable to download %s (HTTP error %d)" % (url, code))
+    return source
+
+
+def tee(source, sinks):
+    """Copy everything read from the file source to every file in sinks"""
+
+    sinks = list(sinks)
+    try:
+        while sinks:
+            chunk = os.read(source.fileno(), 1024 * 64)
+            if not chunk:
+                break
+            for sink in sinks[:]:
+                try:
+                    sink.write(chunk)
+                except IOError:
+                    # this encoder died, but the others can carry on
+                    log.debug("lost an output of tee")
+                    sinks.remove(sink)
+                    sink.close()
+    finally:
+        for sink in sinks:
+            try:
+                sink.close()
+            except IOError:
+                pass
+        source.close()
+
+
+def wav_block_align(fmt):
+    """Return the size of a sample frame described by the wav fmt chunk
+    fmt"""
+    if len(fmt) >= 14:
+        return max(struct.unpack("<H", fmt[12:14])[0], 1)
+    return 1
+
+
+def wav_header(fmt, datasize=None):
+    """Return a wav header with the fmt chunk fmt, for datasize bytes of
+    samples or as many as a wav file can hold"""
+    padding = "\0" * (len(fmt) & 1)
+    size = 20 + len(fmt) + len(padding)
+    if datasize is None:
+        blockalign = wav_block_align(fmt)
+        datasize = (0x7fffffff - size) // blockalign * blockalign
+    return "RIFF" + struct.pack("<I", size + datasize) + "WAVE" + \
+        "fmt " + struct.pack("<I", len(fmt)) + fmt + padding + \
+        "data" + struct.pack("<I", datasize)
+
+
+def wav_layout(fh):
+    """Return the fmt chunk, and the offset and size of the samples, of the
+    wav file fh"""
+    fh.seek(0)
+    header = fh.read(12)
+    if header[:4] != "RIFF" or header[8:12] != "WAVE":
+        raise ValueError("not a wav file")
+    filesize = os.fstat(fh.fileno()).st_size
+    fmt = None
+    offset = 12
+    while True:
+        fh.seek(offset)
+        chunk = fh.read(8)
+        if len(chunk) < 8:
+            raise ValueError("no samples in the wav file")
+        size = struct.unpack("<I", chunk[4:])[0]
+        if chunk[:4] == "data":
+            if fmt is None:
+                raise ValueError("no format in the wav file")
+            # a decoder writing to a pipe can't fill in the size
+            rest = filesize - offset - 8
+            if size == 0 or size > rest:
+                size = rest
+            return fmt, offset + 8, size
+        if chunk[:4] == "fmt ":
+            fmt = fh.read(size)
+        offset += 8 + size + (size & 1)
+
+
+def mp3_frame_length(header):
+    """Return the length of the MPEG audio layer III frame whose header is
+    the 4 byte string header, or None if it isn't one"""
+    if len(header) < 4:
+        return None
+    bits = struct.unpack(">I", header)[0]
+    version = (bits >> 19) & 3
+    layer = (bits >> 17) & 3
+    bitrate = (bits >> 12) & 15
+    rate = (bits >> 10) & 3
+    padding = (bits >> 9) & 1
+    if bits >> 21 != 0x7ff or version == 1 or layer != 1 or \
+            bitrate in (0, 15) or rate == 3:
+        return None
+    rate = (44100, 48000, 32000)[rate]
+    if version == 3:
+        # MPEG 1
+        bitrate = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224,
+            256, 320)[bitrate]
+        return 144000 * bitrate // rate + padding
+    # MPEG 2 and 2.5
+    rate = rate // (version == 2 and 2 or 4)
+    bitrate = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144,
+        160)[bitrate]
+    return 72000 * bitrate // rate + padding
+
+
+def mp3_layout(fh):
+    """Return (end of the ID3v2 tag, start of the frames, end of the frames)
+    in the mp3 file fh. The frames start after the Xing/Info frame if there
+    is one, and end before any ID3v1 tag."""
+    size = os.fstat(fh.fileno()).st_size
+    end = size
+    fh.seek(0)
+    tag_end = id3_size(fh.read(10))
+    if size - tag_end >= 128:
+        fh.seek(size - 128)
+        if fh.read(3) == "TAG":
+            end = size - 128
+    start = tag_end
+    fh.seek(start)
+    frame = fh.read(64)
+    length = mp3_frame_length(frame[:4])
+    if length and ("Xing" in frame or "Info" in frame):
+        start += length
+    return tag_end, min(start, end), end
+
+
+def copy_range(fh, start, end, fd):
+    """Copy bytes start to end of the file fh to the file descriptor fd"""
+    fh.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = fh.read(min(remaining, 1024 * 64))
+        if not chunk:
+            break
+        os.write(fd, chunk)
+        remaining -= len(chunk)
+
+
+def xing_offset(header):
+    """Return where the Xing/Info tag goes in the MPEG audio frame whose
+    header is the 4 byte string header: after the side information"""
+    bits = struct.unpack(">I", header)[0]
+    mpeg1 = (bits >> 19) & 3 == 3
+    mono = (bits >> 6) & 3 == 3
+    offset = 4 + {(True, False): 32, (True, True): 17, (False, False): 17,
+        (False, True): 9}[(mpeg1, mono)]
+    if not bits & 0x10000:
+        # followed by a CRC
+        offset += 2
+    return offset
+
+
+def xing_fields(frame):
+    """Return the name of the Xing/Info tag in frame, and the offset of each
+    of its frame count, byte count, seek table, quality and LAME extension
+    (None for those missing), or None if frame hasn't got one"""
+    offset = xing_offset(frame[:4])
+    name = frame[offset:offset + 4]
+    if name not in ("Xing", "Info") or len(frame) < offset + 8:
+        return None
+    flags = struct.unpack(">I", frame[offset + 4:offset + 8])[0]
+    fields = []
+    offset += 8
+    for bit, size in ((1, 4), (2, 4), (4, 100), (8, 4)):
+        if flags & bit:
+            fields.append(offset)
+            offset += size
+        else:
+            fields.append(None)
+    if frame[offset:offset + 4] == "LAME" and len(frame) >= offset + 36:
+        fields.append(offset)
+    else:
+        fields.append(None)
+    return name, fields
+
+
+def crc16(data):
+    """Return the CRC-16 of the string data, as in the LAME extension"""
+    crc = 0
+    for c in data:
+        crc ^= ord(c)
+        for i in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0xa001
+            else:
+                crc >>= 1
+    return crc
+
+
+def mp3_frames(fh, start, end):
+    """Return the offset of each frame between start and end of the mp3 file
+    fh, from start"""
+    offsets = []
+    offset = start
+    while offset + 4 <= end:
+        fh.seek(offset)
+        length = mp3_frame_length(fh.read(4))
+        if not length:
+            log.debug("no mp3 frame at %d, not counting the rest" % offset)
+            break
+        offsets.append(offset - start)
+        offset += length
+    return offsets
+
+
+def mp3_info_frame(template, offsets, size, delay, padding):
+    """Return a Xing/Info frame describing the size bytes of mp3 frames at
+    offsets which follow it. It copies the header and any tag of template,
+    the first frame of the stream. If the tag had a LAME extension, its
+    encoder delay and padding are replaced by delay and padding, or None if
+    it's too short to hold the tag."""
+    length = mp3_frame_length(template[:4])
+    if length is None or length < xing_offset(template[:4]) + 120 + 36:
+        return None
+    offset = xing_offset(template[:4])
+    xing = xing_fields(template[:length])
+    if xing is None:
+        name, fields = "Xing", [None] * 5
+        frame = template[:4] + "\0" * (length - 4)
+    else:
+        name, fields = xing
+        frame = template[:length]
+    if fields[3] is not None:
+        quality = frame[fields[3]:fields[3] + 4]
+    else:
+        quality = "\0" * 4
+    total = length + size
+    toc = []
+    for i in range(100):
+        if offsets:
+            at = length + offsets[i * len(offsets) // 100]
+        else:
+            at = 0
+        toc.append(chr(min(255, 256 * at // total)))
+    tag = name + struct.pack(">III", 15, len(offsets), total) + \
+        "".join(toc) + quality
+    if fields[4] is not None:
+        lame = frame[fields[4]:fields[4] + 36]
+        # the peak and ReplayGain were measured for one segment only
+        lame = lame[:11] + "\0" * 8 + lame[19:21] + \
+            struct.pack(">I", (delay << 12) | padding)[1:] + lame[24:28] + \
+            struct.pack(">I", total) + lame[32:34]
+        # the music CRC is left as it was: decoders don't check it
+        tag += lame
+        tag += struct.pack(">H", crc16(frame[:offset] + tag))
+    return frame[:offset] + tag + frame[offset + len(tag):]
+
+
+def lame_delay(frame):
+    """Return the encoder delay and padding, in samples, from the LAME
+    extension of the Xing/Info frame frame, or (None, None)"""
+    xing = mp3_frame_length(frame[:4]) and xing_fields(frame)
+    if not xing or xing[1][4] is None:
+        return None, None
+    at = xing[1][4] + 21
+    bits = struct.unpack(">I", "\0" + frame[at:at + 3])[0]
+    return bits >> 12, bits & 0xfff
+
+
+def join_mp3(filenames, fd, trims=None):
+    """Write the mp3 files filenames to fd as one stream. The ID3 tags of the
+    first file are kept. The Xing/Info frame at the start of each file only
+    describes that file, so they are all replaced by one describing the whole
+    stream, with the first file's encoder delay and the last one's padding
+    for gapless players to trim.
+
+    trims gives (frames to skip, frames to keep or None for the rest) for
+    each file, so that files encoded with some overlap join without a gap.
+    """
+    layouts = []
+    offsets = []
+    size = 0
+    first = last = id3v1 = ""
+    for i in range(len(filenames)):
+        fh = open(filenames[i], 'rb')
+        try:
+            tag_end, start, end = mp3_layout(fh)
+            if i == 0:
+                fh.seek(end)
+                id3v1 = fh.read()
+            fh.seek(tag_end)
+            if start > tag_end:
+                last = fh.read(start - tag_end)
+            else:
+                last = ""
+            if i == 0:
+                # the Info frame, or the first frame to copy the header of
+                first = last or fh.read(4)
+            frames = mp3_frames(fh, start, end)
+            if trims:
+                skip, keep = trims[i]
+                if keep is not None and skip + keep < len(frames):
+                    end = start + frames[skip + keep]
+                frames = frames[skip:]
+                if frames:
+                    start += frames[0]
+                    frames = [offset - frames[0] for offset in frames]
+                else:
+                    start = end
+                if keep is not None:
+                    frames = frames[:keep]
+            offsets += [size + offset for offset in frames]
+            size += end - start
+        finally:
+            fh.close()
+        layouts.append((tag_end, start, end))
+    delay = lame_delay(first)[0]
+    padding = lame_delay(last)[1]
+    if delay is None or padding is None:
+        delay = padding = 0
+        first = first[:4]
+    info = mp3_info_frame(first, offsets, size, delay, padding)
+    for i in range(len(filenames)):
+        tag_end, start, end = layouts[i]
+        fh = open(filenames[i], 'rb')
+        try:
+            if i == 0:
+                copy_range(fh, 0, tag_end, fd)
+                if info is not None:
+                    os.write(fd, info)
+            copy_range(fh, start, end, fd)
+        finally:
+            fh.close()
+    os.write(fd, id3v1)
+
+
+def set_pipe_size(pipe, size):
+    """Try to resize the kernel buffer of the pipe file object to size
+    bytes"""
+
+    # F_SETPIPE_SZ, from linux/fcntl.h
+    F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+    try:
+        fcntl.fcntl(pipe.fileno(), F_SETPIPE_SZ, size)
+    except IOError, e:
+        log.debug("unable to resize pipe: " + str(e))
+
+
+def write_atomically(path, write, sync=False):
+    """Replace path with a file written by write(fd), so that anyone reading
+    it sees either the old file or the whole of the new one"""
+    dirname = os.path.dirname(path) or os.curdir
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmpname = tempfile.mkstemp(prefix=".tmp-", dir=dirname)
+    try:
+        try:
+            write(fd)
+            if sync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmpname, path)
+    except Exception:
+        try:
+            os.unlink(tmpname)
+        except OSError:
+            pass
+        raise
+
+
+def copy_to_fd(fileobj, fd):
+    """Copy the remaining contents of fileobj to the file descriptor fd"""
+
+    while True:
+        chunk = fileobj.read(1024 * 64)
+        if not chunk:
+            break
+        while chunk:
+            chunk = chunk[os.write(fd, chunk):]
+
+
+def onHangup(signum, stackframe):
+    """Called on SIGHUP to look for external programs again"""
+
+    tools.refresh()
+
+
+def onStop(signum, stackframe):
+    """Called when script is stopped by user"""
+
+    log.debug("signalled exit")
+    sys.exit()
+
+
+def cpu_times():
+    """Return (total, idle, iowait) cpu time from /proc/stat"""
+
+    fh = open('/proc/stat')
+    try:
+        fields = [float(f) for f in fh.readline().split()[1:]]
+    finally:
+        fh.close()
+    # guest time is already counted in user time
+    fields = fields[:8]
+    while len(fields) < 5:
+        fields.append(0.0)
+    return sum(fields), fields[3], fields[4]
+
+
+def available_memory():
+    """Return the number of bytes of memory available for new processes"""
+
+    meminfo = {}
+    fh = open('/proc/meminfo')
+    try:
+        for line in fh:
+            fields = line.split()
+            if len(fields) >= 2:
+                meminfo[fields[0].rstrip(':')] = int(fields[1]) * 1024
+    finally:
+        fh.close()
+    if 'MemAvailable' in meminfo:
+        return meminfo['MemAvailable']
+    return meminfo['MemFree'] + meminfo.get('Cached', 0) + \
+        meminfo.get('Buffers', 0)
+
+
+def number_of_processors():
+    """Return the number of CPU cores online right now."""
+
+    try:
+        return os.sysconf('SC_NPROCESSORS_ONLN')
+    except:
+        return 1
+
+
+def initLog():
+    """Create a default logging configuration."""
+
+    global log
+    log = logging.getLogger("amaKode")
+    # Default to warts and all logging
+    log.setLevel(logging.DEBUG)
+
+    # Log to this file
+    logfile = logging.handlers.RotatingFileHandler(
+        filename=os.path.join(os.getcwd(), 'amakode.log'),
+        maxBytes=10000, backupCount=3)
+
+    # And stderr
+    logstderr = logging.StreamHandler()
+
+    # Format it nicely
+    formatter = logging.Formatter("[%(name)s] %(message)s")
+
+    # Glue it all together
+    logfile.setFormatter(formatter)
+    logstderr.setFormatter(formatter)
+    log.addHandler(logfile)
+    log.addHandler(logstderr)
+    return log
+
+
+if __name__ == '__main__':
+    main()